@@ -0,0 +1,469 @@
+"""
+Provides an asyncio control interface to the Chromecast Media Player app
+
+One event loop can control many devices, each using a single connection with no extra threads.
+Requires Python 3.6 or later.
+
+version 0.1
+
+"""
+
+
+# Copyright (C) 2014-2016 Pat Carter
+#
+# This file is part of Stream2chromecast.
+#
+# Stream2chromecast is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Stream2chromecast is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Stream2chromecast.  If not, see <http://www.gnu.org/licenses/>.
+
+
+
+import asyncio
+import ssl
+import json
+
+import cc_device_finder
+import cc_message
+from cc_media_controller import MEDIAPLAYER_APPID, RESPONSE_TIMEOUT, PONG_PAYLOAD
+from cc_media_controller import NS_CONNECTION, NS_HEARTBEAT, NS_RECEIVER, NS_MEDIA
+from cc_media_controller import build_load_request, get_ssl_context
+
+
+
+class AsyncCCMediaController():
+    def __init__(self, host, port=8009):
+        """ initialise - call connect() or use 'async with' before sending any commands """
+
+        self.host = host
+        self.port = port
+
+        self.reader = None
+        self.writer = None
+        self.read_task = None
+
+        self.request_id = 1
+        self.source_id = "sender-0"
+        self.pending_requests = {}
+        self.connected_destinations = set()
+        self.status_queues = []
+        self.pong_messages = {}
+
+        self.receiver_app_status = None
+        self.media_status = None
+        self.volume_status = None
+        self.current_applications = None
+
+        self.session_id = None
+        self.transport_id = None
+        self.media_session_id = None
+
+
+
+    @classmethod
+    async def find(cls, device_name=None):
+        """ create a controller for a device found by name, or the first device on the network """
+
+        loop = asyncio.get_event_loop()
+        host, name = await loop.run_in_executor(None, cc_device_finder.find_device, device_name)
+        if host is None:
+            raise LookupError("No Chromecast found on the network")
+
+        return cls(host)
+
+
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+
+
+    async def connect(self):
+        """ open the connection to the device and start reading messages from it """
+
+        if self.writer is not None:
+            return
+
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port, ssl=get_ssl_context())
+        self.connected_destinations = set()
+
+        self.read_task = asyncio.ensure_future(self.read_messages())
+
+
+
+    async def close(self):
+        """ close the connection to the device """
+
+        if self.writer is None:
+            return
+
+        self.writer.close()
+        self.writer = None
+
+        if self.read_task is not None:
+            self.read_task.cancel()
+            try:
+                await self.read_task
+            except asyncio.CancelledError:
+                pass
+            self.read_task = None
+
+
+
+    def connect_destination(self, destination_id):
+        """ open a virtual connection to the receiver or the media transport """
+
+        if destination_id in self.connected_destinations:
+            return
+
+        self.send_data(NS_CONNECTION, {"type":"CONNECT","origin":{}}, destination_id)
+        self.connected_destinations.add(destination_id)
+
+
+
+    def send_data(self, namespace, data_dict, destination_id):
+        """ send data to the device in binary format """
+
+        if self.writer is None:
+            raise ConnectionError("not connected to the device")
+
+        msg = cc_message.format_message(self.source_id, destination_id, namespace, json.dumps(data_dict))
+        self.writer.write(msg)
+
+
+
+    async def send_msg_with_response(self, namespace, data, destination_id):
+        """ send a request to the device and wait for a response matching the request id.
+            returns an empty dict if no response arrives in time """
+
+        self.request_id += 1
+        request_id = self.request_id
+        data['requestId'] = request_id
+
+        future = asyncio.get_event_loop().create_future()
+        self.pending_requests[request_id] = future
+
+        try:
+            self.send_data(namespace, data, destination_id)
+            await self.writer.drain()
+
+            return await asyncio.wait_for(future, RESPONSE_TIMEOUT)
+        except asyncio.TimeoutError:
+            return {}
+        finally:
+            self.pending_requests.pop(request_id, None)
+
+
+
+    def receive_data(self, decoder, data):
+        """ feed received data to the decoder and handle each complete message.
+            No message is held once this returns, so the decoder can reuse its buffer for the next data """
+
+        decoder.feed(data)
+
+        for message in decoder.messages():
+            cast_message = cc_message.CastMessage(message)
+
+            if cast_message.get_raw_field("namespace") == NS_HEARTBEAT.encode():
+                if b'"PING"' in bytes(cast_message.get_raw_field("payload_utf8") or b""):
+                    self.send_pong(cast_message.source_id)
+                continue
+
+            try:
+                msg = json.loads(cast_message.payload_utf8)
+            except (TypeError, ValueError):
+                continue
+
+            if not isinstance(msg, dict):
+                # valid JSON, but not a message object
+                continue
+
+            self.handle_message(cast_message.source_id, msg)
+
+
+
+    async def read_messages(self):
+        """ handle every message from the device until the connection is closed """
+
+        writer = self.writer
+        decoder = cc_message.MessageDecoder()
+
+        error = ConnectionError("connection to the device closed")
+        try:
+            while True:
+                data = await self.reader.read(65536)
+                if len(data) == 0:
+                    break
+
+                self.receive_data(decoder, data)
+
+        except (ConnectionError, ssl.SSLError, ValueError) as e:
+            error = ConnectionError("connection to the device lost: %s" % e)
+
+        finally:
+            # the next command reconnects, and finds the player app session again
+            if self.writer is writer:
+                writer.close()
+                self.reader = None
+                self.writer = None
+                self.connected_destinations = set()
+                self.clear_session()
+
+            for future in self.pending_requests.values():
+                if not future.done():
+                    future.set_exception(error)
+
+            for queue in self.status_queues:
+                queue.put_nowait(None)
+
+
+
+    def handle_message(self, source_id, msg):
+        """ update the status from a message and pass a response to the request waiting for it """
+
+        msg_type = msg.get("type", msg.get("responseType", ""))
+
+        if msg_type == "RECEIVER_STATUS":
+            self.update_receiver_status_data(msg)
+
+        elif msg_type == "MEDIA_STATUS":
+            self.update_media_status_data(msg)
+
+        elif msg_type == "CLOSE":
+            self.clear_session()
+
+        if msg_type in ("RECEIVER_STATUS", "MEDIA_STATUS", "CLOSE"):
+            for queue in self.status_queues:
+                queue.put_nowait((msg_type, msg))
+
+        future = self.pending_requests.get(msg.get("requestId"))
+        if future is not None and not future.done():
+            future.set_result(msg)
+
+
+
+    def send_pong(self, destination_id):
+        """ answer a heartbeat PING with a PONG message which is only encoded once """
+
+        msg = self.pong_messages.get(destination_id)
+        if msg is None:
+            msg = cc_message.format_message(self.source_id, destination_id, NS_HEARTBEAT, PONG_PAYLOAD)
+            self.pong_messages[destination_id] = msg
+
+        if self.writer is not None:
+            self.writer.write(msg)
+
+
+
+    def update_receiver_status_data(self, msg):
+        """ update the status for the Media Player app if it is running """
+
+        self.receiver_app_status = None
+
+        status = msg.get('status', {})
+        if 'applications' in status:
+            self.current_applications = status['applications']
+            for application in self.current_applications:
+                if application.get("appId") == MEDIAPLAYER_APPID:
+                    self.receiver_app_status = application
+
+        if 'volume' in status:
+            self.volume_status = status['volume']
+
+        if self.receiver_app_status is None:
+            self.clear_session()
+
+        elif self.receiver_app_status.get('sessionId') != self.session_id:
+            self.clear_session()
+            self.session_id = self.receiver_app_status.get('sessionId')
+            self.transport_id = str(self.receiver_app_status['transportId'])
+
+
+
+    def update_media_status_data(self, msg):
+        """ update the media status if there is any media loaded """
+
+        self.media_status = None
+
+        status = msg.get("status", [])
+        if len(status) > 0:
+            self.media_status = status[0]
+            self.media_session_id = self.media_status.get('mediaSessionId')
+
+
+
+    def clear_session(self):
+        """ forget the media player app session """
+
+        if self.transport_id is not None:
+            self.connected_destinations.discard(self.transport_id)
+
+        self.session_id = None
+        self.transport_id = None
+        self.media_session_id = None
+
+
+
+    async def get_receiver_status(self):
+        """ send a status request to the receiver """
+
+        await self.connect()
+        self.connect_destination("receiver-0")
+        await self.send_msg_with_response(NS_RECEIVER, {"type":"GET_STATUS"}, "receiver-0")
+
+
+
+    async def get_media_status(self):
+        """ send a status request to the media player """
+
+        await self.connect()
+
+        if self.transport_id is None:
+            # the session isn't known, e.g. after reconnecting
+            await self.get_receiver_status()
+
+            if self.transport_id is None:
+                self.media_status = None
+                return
+
+        self.connect_destination(self.transport_id)
+        await self.send_msg_with_response(NS_MEDIA, {"type":"GET_STATUS"}, self.transport_id)
+
+
+
+    async def load(self, content_url, content_type, sub=None, sub_language=None):
+        """ launch the player app if it isn't running, then load & play a URL.
+            returns the response to the LOAD request """
+
+        await self.get_receiver_status()
+
+        if self.receiver_app_status is None:
+            await self.send_msg_with_response(NS_RECEIVER, {"type":"LAUNCH","appId":MEDIAPLAYER_APPID}, "receiver-0")
+
+            if self.receiver_app_status is None:
+                raise RuntimeError("Cannot launch the Media Player app")
+
+        self.connect_destination(self.transport_id)
+
+        data = build_load_request(str(self.session_id), content_url, content_type, sub, sub_language)
+
+        return await self.send_msg_with_response(NS_MEDIA, data, self.transport_id)
+
+
+
+    async def control(self, command, parameters=None):
+        """ send a control command to the player, returns False if the player app isn't running """
+
+        await self.connect()
+
+        if self.transport_id is None or self.media_session_id is None:
+            await self.get_receiver_status()
+
+            if self.receiver_app_status is None:
+                return False
+
+            await self.get_media_status()
+
+        self.connect_destination(self.transport_id)
+
+        data = {"type":command, "mediaSessionId":self.media_session_id or 1}
+        if parameters is not None:
+            data.update(parameters)
+
+        await self.send_msg_with_response(NS_MEDIA, data, self.transport_id)
+
+        return True
+
+
+
+    async def get_status(self):
+        """ get the receiver and media status """
+
+        await self.get_receiver_status()
+
+        if self.receiver_app_status is not None:
+            await self.get_media_status()
+        else:
+            self.media_status = None
+
+        application_list = []
+        for application in self.current_applications or []:
+            application_list.append({
+                'appId':application.get('appId', ""),
+                'displayName':application.get('displayName', ""),
+                'statusText':application.get('statusText', "")})
+
+        return {'receiver_status':self.receiver_app_status,
+                'media_status':self.media_status,
+                'host':self.host,
+                'client':self.writer.get_extra_info("sockname"),
+                'applications':application_list}
+
+
+
+    async def set_volume(self, level):
+        """ set the receiver volume - a float value in level for absolute level or "+" / "-" indicates up or down"""
+
+        await self.get_receiver_status()
+
+        if level in ("+", "-"):
+            if self.volume_status is None:
+                return
+
+            curr_level = self.volume_status['level']
+            if level == "+":
+                level = curr_level + 0.1
+            else:
+                level = curr_level - 0.1
+
+        data = {"type":"SET_VOLUME", "volume":{"muted":False, "level":level}}
+        await self.send_msg_with_response(NS_RECEIVER, data, "receiver-0")
+
+
+
+    async def pause(self):
+        """ pause """
+        await self.control("PAUSE")
+
+
+    async def play(self):
+        """ unpause """
+        await self.control("PLAY")
+
+
+    async def stop(self):
+        """ stop """
+        await self.control("STOP")
+
+
+
+    async def status_events(self):
+        """ async iterator of (message type, message) for each RECEIVER_STATUS, MEDIA_STATUS & CLOSE message,
+            including broadcasts. Ends when the connection is closed """
+
+        queue = asyncio.Queue()
+        self.status_queues.append(queue)
+
+        try:
+            while True:
+                event = await queue.get()
+                if event is None:
+                    return
+
+                yield event
+        finally:
+            self.status_queues.remove(queue)
@@ -0,0 +1,328 @@
+"""
+Microbenchmarks for the Chromecast message handling.
+
+Runs offline - no device is needed.
+
+    python cc_benchmark.py
+
+version 0.2
+
+"""
+
+
+# Copyright (C) 2014-2016 Pat Carter
+#
+# This file is part of Stream2chromecast.
+#
+# Stream2chromecast is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Stream2chromecast is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Stream2chromecast.  If not, see <http://www.gnu.org/licenses/>.
+
+
+
+import time
+import json
+import socket
+import threading
+
+try:
+    import tracemalloc
+except ImportError:
+    # Python 2 - allocations aren't measured
+    tracemalloc = None
+
+import cc_message
+import cc_media_controller
+
+
+# approximate number of seconds spent running each benchmark
+DURATION = 1.0
+
+# number of calls made while measuring the memory allocated per call
+ALLOCATION_CALLS = 200
+
+# the most accurate clock for timing single calls
+timer = getattr(time, "perf_counter", time.time)
+
+
+
+def percentile(sorted_values, fraction):
+    """ returns the value at the fraction (0 - 1) of the way through a sorted list """
+    
+    index = int(fraction * (len(sorted_values) - 1))
+    return sorted_values[index]
+    
+
+
+def measure_allocations(func):
+    """ returns the mean peak & retained bytes allocated by a call to func, or None if tracemalloc isn't available """
+    
+    if tracemalloc is None:
+        return None
+        
+    func()
+    
+    tracemalloc.start()
+    try:
+        peak_total = 0
+        retained_total = 0
+        for i in range(ALLOCATION_CALLS):
+            tracemalloc.clear_traces()
+            func()
+            current, peak = tracemalloc.get_traced_memory()
+            peak_total += peak
+            retained_total += current
+    finally:
+        tracemalloc.stop()
+        
+    return peak_total / float(ALLOCATION_CALLS), retained_total / float(ALLOCATION_CALLS)
+
+
+
+def run_benchmark(name, func, measure_memory=True):
+    """ call func repeatedly for about DURATION seconds and print the number of calls per second, 
+        the median & 99th percentile time of a call and the memory it allocates.
+        Each call is timed separately, so the timer overhead is included in the results for very fast functions.
+        tracemalloc counts the allocations of every thread, so measure_memory should be False while 
+        other threads are running """
+
+    latencies = []
+    start_time = timer()
+    elapsed = 0
+
+    while elapsed < DURATION:
+        call_start = timer()
+        func()
+        call_end = timer()
+        
+        latencies.append(call_end - call_start)
+        elapsed = call_end - start_time
+
+    rate = len(latencies) / elapsed
+    
+    latencies.sort()
+    p50 = percentile(latencies, 0.5) * 1000000
+    p99 = percentile(latencies, 0.99) * 1000000
+    
+    allocations = None
+    if measure_memory:
+        allocations = measure_allocations(func)
+        
+    if allocations is None:
+        allocation_text = ""
+    else:
+        allocation_text = "%8.0f B peak %6.0f B kept" % allocations
+        
+    print("%-40s %10.0f ops/sec %8.1f us p50 %8.1f us p99 %s" % (name, rate, p50, p99, allocation_text))
+
+    return rate
+
+
+
+def benchmark_format_message():
+    """ format a heartbeat PONG and a media status request """
+
+    pong = json.dumps({"type":"PONG"})
+    status_request = json.dumps({"type":"GET_STATUS", "requestId":12345})
+
+    run_benchmark("format_message (PONG)",
+                  lambda: cc_message.format_message("sender-0", "receiver-0", cc_media_controller.NS_HEARTBEAT, pong))
+    run_benchmark("format_message (media GET_STATUS)",
+                  lambda: cc_message.format_message("sender-0", "web-5", cc_media_controller.NS_MEDIA, status_request))
+
+
+
+def get_media_status_message(request_id=0):
+    """ returns a typical MEDIA_STATUS message from a device """
+    
+    return {"type":"MEDIA_STATUS", 
+            "requestId":request_id,
+            "status":[{"mediaSessionId":1, 
+                       "playbackRate":1, 
+                       "playerState":"PLAYING", 
+                       "currentTime":123.456,
+                       "supportedMediaCommands":15,
+                       "volume":{"level":1, "muted":False},
+                       "media":{"contentId":"http://192.168.1.2:8000/video.mp4",
+                                "streamType":"BUFFERED",
+                                "contentType":"video/mp4",
+                                "duration":5400.5}}]}
+
+
+
+def benchmark_extract_message():
+    """ decode received messages - the length header is removed, as it is by the MessageDecoder """
+    
+    ping = cc_message.format_message("receiver-0", "sender-0", cc_media_controller.NS_HEARTBEAT, json.dumps({"type":"PING"}))[4:]
+    media_status = cc_message.format_message("web-5", "sender-0", cc_media_controller.NS_MEDIA, 
+                                             json.dumps(get_media_status_message()))[4:]
+    
+    run_benchmark("extract_message (PING)", lambda: cc_message.extract_message(ping))
+    run_benchmark("extract_message (MEDIA_STATUS)", lambda: cc_message.extract_message(media_status))
+    run_benchmark("CastMessage namespace only (MEDIA_STATUS)", lambda: cc_message.CastMessage(media_status).namespace)
+    
+    decoder = cc_message.MessageDecoder()
+    stream = cc_message.format_message("web-5", "sender-0", cc_media_controller.NS_MEDIA, json.dumps(get_media_status_message()))
+    def decode_stream():
+        decoder.feed(stream)
+        for message in decoder.messages():
+            pass
+            
+    run_benchmark("MessageDecoder feed & split", decode_stream)
+    
+    # a message held between feeds stops the decoder reusing its buffer - it is copied on every feed instead
+    held_decoder = cc_message.MessageDecoder()
+    held = []
+    def decode_stream_held():
+        held_decoder.feed(stream)
+        for message in held_decoder.messages():
+            held[:] = [message]
+            
+    run_benchmark("MessageDecoder feed & split (message held)", decode_stream_held)
+    print_buffer_copies(held_decoder)
+    
+
+
+def print_buffer_copies(decoder):
+    """ show how often the decoder had to copy its buffer, which should be never for a reader which 
+        releases each message before more data is fed """
+    
+    print("%-40s %10d buffer copies" % ("", decoder.buffer_copies))
+    
+    
+    
+def benchmark_varint():
+    """ encode & decode small and multi-byte varints """
+    
+    small = cc_message.format_varint_value(100)
+    large = cc_message.format_varint_value(1000000)
+    small_view = cc_message.get_byte_view(small)
+    large_view = cc_message.get_byte_view(large)
+    
+    run_benchmark("varint encode (1 byte)", lambda: cc_message.format_varint_value(100))
+    run_benchmark("varint encode (3 bytes)", lambda: cc_message.format_varint_value(1000000))
+    run_benchmark("varint decode (1 byte)", lambda: cc_message.decode_varint(small_view, 0))
+    run_benchmark("varint decode (3 bytes)", lambda: cc_message.decode_varint(large_view, 0))
+    
+
+
+def benchmark_json():
+    """ encode requests & decode status payloads """
+    
+    load_request = cc_media_controller.build_load_request("session-1", "http://192.168.1.2:8000/video.mp4", "video/mp4")
+    media_status = json.dumps(get_media_status_message())
+    
+    run_benchmark("json encode (LOAD request)", lambda: json.dumps(load_request))
+    run_benchmark("json decode (MEDIA_STATUS)", lambda: json.loads(media_status))
+    
+    
+
+class FakeDevice():
+    """ The device end of an in-process socket pair - answers every request with a MEDIA_STATUS message """
+    
+    def __init__(self, sock):
+        self.sock = sock
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+        
+        
+    def run(self):
+        decoder = cc_message.MessageDecoder()
+        response = get_media_status_message()
+        
+        try:
+            while True:
+                data = self.sock.recv(65536)
+                if len(data) == 0:
+                    return
+                    
+                decoder.feed(data)
+                
+                for message in decoder.messages():
+                    cast_message = cc_message.CastMessage(message)
+                    if cast_message.namespace != cc_media_controller.NS_MEDIA:
+                        continue
+                        
+                    response['requestId'] = json.loads(cast_message.payload_utf8)['requestId']
+                    self.sock.sendall(cc_message.format_message(cast_message.destination_id, cast_message.source_id, 
+                                                                cast_message.namespace, json.dumps(response)))
+        except socket.error:
+            pass
+
+
+
+class BenchmarkController(cc_media_controller.CCMediaController):
+    """ A controller connected to a FakeDevice rather than a device on the network """
+    
+    def get_device(self, device_name):
+        return "localhost"
+        
+        
+    def open_socket(self):
+        if self.sock is None:
+            self.sock, device_sock = socket.socketpair()
+            self.device = FakeDevice(device_sock)
+            
+            self.reader_thread = threading.Thread(target=self.read_messages, args=(self.sock,))
+            self.reader_thread.daemon = True
+            self.reader_thread.start()
+            
+            
+            
+def benchmark_controller():
+    """ the request / response loop of the controller, including the reader thread hand-off, 
+        and the handling of heartbeats & broadcast messages.
+        Allocations aren't measured - the reader & fake device threads allocate while each call is made """
+    
+    controller = BenchmarkController(persistent=True)
+    controller.open_socket()
+    controller.destination_id = "web-5"
+    
+    try:
+        run_benchmark("controller GET_STATUS round trip", 
+                      lambda: controller.send_msg_with_response(cc_media_controller.NS_MEDIA, {"type":"GET_STATUS"}), 
+                      measure_memory=False)
+        
+        ping = cc_message.format_message("receiver-0", "sender-0", cc_media_controller.NS_HEARTBEAT, json.dumps({"type":"PING"}))[4:]
+        run_benchmark("controller dispatch (PING)", lambda: controller.dispatch_message(ping), measure_memory=False)
+        
+        media_status = cc_message.format_message("web-5", "sender-0", cc_media_controller.NS_MEDIA, 
+                                                 json.dumps(get_media_status_message()))[4:]
+        run_benchmark("controller dispatch (MEDIA_STATUS)", lambda: controller.dispatch_message(media_status), measure_memory=False)
+        
+        other = cc_message.format_message("web-5", "sender-0", "urn:x-cast:com.example.unused", 
+                                          json.dumps(get_media_status_message()))[4:]
+        run_benchmark("controller dispatch (unhandled namespace)", lambda: controller.dispatch_message(other), measure_memory=False)
+        
+        # the reader thread's loop - the data is fed & split as it is received from the socket
+        decoder = cc_message.MessageDecoder()
+        stream = cc_message.format_message("web-5", "sender-0", cc_media_controller.NS_MEDIA, 
+                                           json.dumps(get_media_status_message()))
+        run_benchmark("controller receive (MEDIA_STATUS)", lambda: controller.receive_data(decoder, stream), measure_memory=False)
+        print_buffer_copies(decoder)
+    finally:
+        controller.close_socket()
+
+
+
+def main():
+    benchmark_format_message()
+    benchmark_extract_message()
+    benchmark_varint()
+    benchmark_json()
+    benchmark_controller()
+
+
+
+if __name__ == "__main__":
+    main()
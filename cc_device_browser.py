@@ -0,0 +1,372 @@
+"""
+Keeps a live table of the Chromecast devices on the network, and answers lookups over a Unix socket.
+
+The browser listens for the mDNS announcements & goodbyes sent by devices as they join & leave the network,
+and queries the network again before the announced records expire. While it is running, find_device() asks
+the browser rather than searching the network, so no time is spent waiting for devices to respond.
+
+    python cc_device_browser.py
+
+version 0.1
+
+"""
+
+
+# Copyright (C) 2014-2016 Pat Carter
+#
+# This file is part of Stream2chromecast.
+#
+# Stream2chromecast is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Stream2chromecast is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Stream2chromecast.  If not, see <http://www.gnu.org/licenses/>.
+
+
+
+import os
+import sys
+import socket
+import select
+import errno
+import json
+import time
+import signal
+import threading
+
+import cc_mdns
+import cc_device_finder
+
+
+# the most seconds between queries of the network - devices are also queried again before their records expire
+QUERY_INTERVAL = 60
+
+# records are refreshed when this fraction of their ttl has passed, as mDNS recommends
+REFRESH_FRACTION = 0.8
+
+# seconds allowed for a client to send its request
+CLIENT_TIMEOUT = 1
+
+# the longest request accepted from a client
+MAX_REQUEST_SIZE = 4096
+
+
+
+class DeviceBrowser():
+    def __init__(self, socket_path=None):
+        """ initialise - the Unix socket is at cc_device_finder.BROWSER_SOCKET unless another path is given """
+
+        self.socket_path = os.path.expanduser(socket_path or cc_device_finder.BROWSER_SOCKET)
+
+        # service instance name : device details, including when it expires
+        self.devices = {}
+        self.lock = threading.Lock()
+
+        self.mdns_sock = None
+        self.server_sock = None
+        self.clients = {}
+        self.next_query_time = 0
+
+
+
+    def start(self):
+        """ open the mDNS & Unix sockets - exits if a browser is already running """
+
+        if cc_device_finder.query_browser(socket_path=self.socket_path) is not None:
+            sys.exit("A device browser is already running on " + self.socket_path)
+
+        # the socket file is left behind if a browser doesn't exit cleanly
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+        self.server_sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server_sock.bind(self.socket_path)
+        os.chmod(self.socket_path, 0o600)
+        self.server_sock.listen(50)
+        self.server_sock.setblocking(0)
+
+        # opening the mDNS socket sends the first query
+        self.mdns_sock = cc_device_finder.open_mdns_socket()
+        self.next_query_time = time.time() + QUERY_INTERVAL
+
+        print("device browser listening on " + self.socket_path)
+
+
+
+    def stop(self):
+        """ close the sockets """
+
+        for sock in list(self.clients.keys()) + [self.mdns_sock, self.server_sock]:
+            if sock is not None:
+                sock.close()
+
+        self.clients = {}
+        self.mdns_sock = None
+
+        if self.server_sock is not None:
+            self.server_sock = None
+            os.remove(self.socket_path)
+
+
+
+    def run(self):
+        """ handle mDNS messages & lookups until interrupted or terminated """
+
+        self.start()
+
+        # exit through the finally clause when terminated, so the socket file is removed
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+        try:
+            while True:
+                timeout = max(self.get_next_event_time() - time.time(), 0)
+
+                readable = select.select([self.mdns_sock, self.server_sock] + list(self.clients.keys()), [], [], timeout)[0]
+
+                for sock in readable:
+                    if sock is self.mdns_sock:
+                        self.read_mdns()
+
+                    elif sock is self.server_sock:
+                        self.accept_client()
+
+                    else:
+                        self.read_request(sock)
+
+                self.expire_devices()
+                self.expire_clients()
+
+                if time.time() >= self.next_query_time:
+                    self.send_query()
+
+        except KeyboardInterrupt:
+            pass
+
+        finally:
+            self.stop()
+
+
+
+    def get_next_event_time(self):
+        """ the time when a device will expire or should be refreshed, or the next query should be sent """
+
+        event_time = self.next_query_time
+
+        with self.lock:
+            for device in self.devices.values():
+                event_time = min(event_time, device['refresh_time'], device['expires'])
+
+        for client_timeout in self.clients.values():
+            event_time = min(event_time, client_timeout)
+
+        return event_time
+
+
+
+    # mDNS
+
+    def send_query(self):
+        """ query the network for Cast devices - devices on the network respond, refreshing their records """
+
+        try:
+            self.mdns_sock.sendto(cc_mdns.build_query(cc_mdns.CAST_SERVICE), 0, ('224.0.0.251', 5353))
+        except socket.error as e:
+            print("unable to send mDNS query: %s" % e)
+
+        self.next_query_time = time.time() + QUERY_INTERVAL
+
+
+
+    def read_mdns(self):
+        """ update the device table from an mDNS response, announcement or goodbye """
+
+        try:
+            data, addr = self.mdns_sock.recvfrom(9000)
+        except socket.error:
+            return
+
+        try:
+            found = cc_mdns.get_cast_devices(data, addr[0], include_goodbyes=True)
+        except ValueError:
+            # not a valid DNS message
+            return
+
+        for device in found:
+            if device['ttl'] == 0:
+                self.remove_device(device['instance'], "left the network")
+            else:
+                self.add_device(device)
+
+
+
+    def add_device(self, device):
+        """ add a device to the table, or refresh it """
+
+        now = time.time()
+
+        with self.lock:
+            known_device = self.devices.get(device['instance'])
+
+            # a response without a TXT record keeps the details already known
+            if known_device is not None:
+                for key in ('name', 'uuid', 'model', 'port'):
+                    if device[key] is None:
+                        device[key] = known_device[key]
+
+            device['last_seen'] = now
+            device['expires'] = now + device['ttl']
+            device['refresh_time'] = now + device['ttl'] * REFRESH_FRACTION
+
+            self.devices[device['instance']] = device
+
+        if known_device is None:
+            print("found %s at %s" % (device['name'], device['host']))
+
+            if device['name'] is None:
+                # the name wasn't in the announcement, so ask the device for it without holding up the browser
+                thread = threading.Thread(target=self.resolve_name, args=(device,))
+                thread.daemon = True
+                thread.start()
+
+
+
+    def resolve_name(self, device):
+        """ name thread - request the name of a device which didn't announce it """
+
+        name = cc_device_finder.get_device_name(device['host'])
+        if name != "":
+            with self.lock:
+                device['name'] = name
+
+
+
+    def remove_device(self, instance, reason):
+        with self.lock:
+            device = self.devices.pop(instance, None)
+
+        if device is not None:
+            print("%s at %s %s" % (device['name'], device['host'], reason))
+
+
+
+    def expire_devices(self):
+        """ remove devices whose records have expired, and query again for devices which are due a refresh """
+
+        now = time.time()
+        refresh = False
+
+        with self.lock:
+            devices = list(self.devices.items())
+
+        for instance, device in devices:
+            if now >= device['expires']:
+                self.remove_device(instance, "expired")
+
+            elif now >= device['refresh_time']:
+                # only one refresh query is made for each ttl
+                device['refresh_time'] = device['expires']
+                refresh = True
+
+        if refresh:
+            self.send_query()
+
+
+
+    # lookups
+
+    def accept_client(self):
+        try:
+            client_sock, addr = self.server_sock.accept()
+        except socket.error:
+            return
+
+        client_sock.setblocking(0)
+        self.clients[client_sock] = time.time() + CLIENT_TIMEOUT
+
+
+
+    def read_request(self, client_sock):
+        """ answer a lookup - the request is a line of JSON, optionally containing a name, uuid or host.
+            The response is a line of JSON containing the list of matching devices """
+
+        try:
+            data = client_sock.recv(MAX_REQUEST_SIZE)
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            data = b""
+
+        if b"\n" not in data:
+            # an incomplete request - requests are small enough to arrive in one piece
+            self.close_client(client_sock)
+            return
+
+        try:
+            request = json.loads(data.split(b"\n")[0].decode("utf-8"))
+        except ValueError:
+            request = None
+
+        if not isinstance(request, dict):
+            self.close_client(client_sock)
+            return
+
+        with self.lock:
+            devices = list(self.devices.values())
+
+        for key in ('name', 'uuid', 'host'):
+            if request.get(key) is not None:
+                devices = [device for device in devices if device[key] == request[key]]
+
+        response = json.dumps({'devices':[self.get_device_details(device) for device in devices]}) + "\n"
+
+        try:
+            client_sock.setblocking(1)
+            client_sock.settimeout(CLIENT_TIMEOUT)
+            client_sock.sendall(response.encode("utf-8"))
+        except socket.error:
+            pass
+
+        self.close_client(client_sock)
+
+
+
+    def get_device_details(self, device):
+        """ the device details sent to clients - the same as the details found by a network search """
+
+        details = {}
+        for key in ('host', 'port', 'name', 'uuid', 'model'):
+            details[key] = device[key]
+
+        # the time remaining before the records expire
+        details['ttl'] = max(int(device['expires'] - time.time()), 0)
+
+        return details
+
+
+
+    def close_client(self, client_sock):
+        self.clients.pop(client_sock, None)
+        client_sock.close()
+
+
+
+    def expire_clients(self):
+        """ close connections from clients which haven't sent a request in time """
+
+        now = time.time()
+        for client_sock, client_timeout in list(self.clients.items()):
+            if now >= client_timeout:
+                self.close_client(client_sock)
+
+
+
+
+if __name__ == "__main__":
+    DeviceBrowser().run()
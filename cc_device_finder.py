@@ -1,7 +1,7 @@
 """
 Locates Chromecast devices on the local network.
 
-version 0.4
+version 0.6
 
 Parts of this are adapted from code found in PyChromecast - https://github.com/balloob/pychromecast
 
@@ -29,7 +29,6 @@ Parts of this are adapted from code found in PyChromecast - https://github.com/b
 
 import os
 import socket, select
-import datetime
 
 try:
     from urllib.parse import urlparse
@@ -43,107 +42,227 @@ except ImportError:
 
 from xml.etree import ElementTree
 
-import struct
 import json
+import time
+import tempfile
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    # the cache file isn't locked on systems without fcntl
+    fcntl = None
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import cc_mdns
 
 CACHE_FILE = "~/.cc_device_cache"
+CACHE_VERSION = 1
 
-SSDP_ENABLED = False
+# seconds to wait for a cached device to accept a connection
+PROBE_TIMEOUT = 0.1
+
+# the protocols used to search for devices - both searches are made at the same time
+SSDP_ENABLED = True
 MDNS_ENABLED = True
 
+# seconds to wait for a device to respond to a name request
+NAME_REQUEST_TIMEOUT = 3
+
+# the most name requests made at the same time
+NAME_RESOLVER_THREADS = 8
+
+# the Unix socket of the device browser (cc_device_browser.py) & seconds to wait for it to answer
+BROWSER_SOCKET = "~/.cc_device_browser.sock"
+BROWSER_TIMEOUT = 0.5
+
 
 def search_network(device_limit=None, time_limit=5):
     """ Search network for Chromecast devices using mDNS and SSDP """
-    addrs = []
     
-    if MDNS_ENABLED:
-        addrs += search_network_mdns(device_limit=device_limit, time_limit=time_limit)
-        if device_limit and len(addrs) >= device_limit:
-            return addrs
-            
-    if SSDP_ENABLED or len(addrs) == 0:
-        addrs += search_network_ssdp(device_limit=device_limit, time_limit=time_limit)
-        
-    return addrs
+    return [device['host'] for device in search_network_devices(device_limit=device_limit, time_limit=time_limit)]
+    
+    
+    
+def search_network_devices(device_limit=None, time_limit=5):
+    """ Search network for Chromecast devices using mDNS and SSDP, returns a dict of details for each device. 
+        The name is None for devices found by SSDP, or if the mDNS response didn't include it """
+    
+    return list(limit_devices(discover_devices(time_limit=time_limit), device_limit))
     
 
 
 def search_network_ssdp(device_limit=None, time_limit=5):
     """ SSDP discovery """
     
-    addrs = []
+    devices = discover_devices(time_limit=time_limit, use_mdns=False, use_ssdp=True)
     
-    start_time  = datetime.datetime.now() 
- 
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    sock.setblocking(0)
-    
-    req = "\r\n".join(['M-SEARCH * HTTP/1.1',
-                       'HOST: 239.255.255.250:1900',
-                       'MAN: "ssdp:discover"',
-                       'MX: 1',
-                       'ST: urn:dial-multiscreen-org:service:dial:1',
-                       '',''])
-                       
-    sock.sendto(req.encode(), ("239.255.255.250", 1900))
-
-
-    while True:
-        time_remaining = time_limit - (datetime.datetime.now() - start_time).seconds
-        if time_remaining <= 0:
-            break
-            
-        readable = select.select([sock], [], [], time_remaining)[0]
-
-        if sock in readable:
-            st, addr = None, None
-            
-            data = sock.recv(1024).decode()
-
-            for line in data.split("\r\n"):
-                line = line.replace(" ", "")
-            
-                if line.upper().startswith("LOCATION:"):
-                    addr = urlparse(line[9:].strip()).hostname
-                
-                elif line.upper().startswith("ST:"):
-                    st = line[3:].strip()
-
-
-            if addr is not None and st == "urn:dial-multiscreen-org:service:dial:1":
-                addrs.append(addr)
-                
-                if device_limit and len(addrs) == device_limit:
-                    break
-
-
-    sock.close()
-
-    return addrs
+    return [device['host'] for device in limit_devices(devices, device_limit)]
     
     
     
 def search_network_mdns(device_limit=None, time_limit=5):
     """ mDNS discovery """
     
-    addrs = []
-
-    # A rough and ready quick-hack mDNS client - this should be improved
- 
+    return [device['host'] for device in search_network_mdns_devices(device_limit=device_limit, time_limit=time_limit)]
+    
+    
+    
+def search_network_mdns_devices(device_limit=None, time_limit=5):
+    """ mDNS discovery - returns a dict of host, port, name, uuid, model & ttl for each device found, 
+        read from the device's response so no further request is needed for its name """
+    
+    devices = discover_devices(time_limit=time_limit, use_mdns=True, use_ssdp=False)
+    
+    return list(limit_devices(devices, device_limit))
+    
     
-    # build query
-    query_format = "\x00\x00\x00\x00\x00\x01\x00\x00\x00\x00\x00\x00%s\x00\x00\x0c\x00\x01"
     
-    service_type = "_googlecast._tcp.local."
+def limit_devices(devices, device_limit):
+    """ generates the devices from a search, stopping the search once device_limit devices have been found """
     
-    query_data = ""
-    for query_part in service_type.split("."):
-        if len(query_part) > 0:
-            query_data += struct.pack("b", len(query_part)) + query_part
+    count = 0
+    for device in devices:
+        yield device
+        
+        count += 1
+        if device_limit and count >= device_limit:
+            print("enough devices found")
+            devices.close()
+            return
+            
+            
+            
+def discover_devices(time_limit=5, use_mdns=MDNS_ENABLED, use_ssdp=SSDP_ENABLED):
+    """ search the network with mDNS and SSDP at the same time, generating a dict of details for each device 
+        as soon as it responds. The search stops at the time limit, or when the generator is closed.
+        Devices are only generated once, even if they respond to both searches """
+    
+    sockets = {}
+    seen = set()
+    
+    try:
+        if use_mdns:
+            print("Sending mDNS query")
+            sockets[open_mdns_socket()] = read_mdns_response
+            
+        if use_ssdp:
+            sockets[open_ssdp_socket()] = read_ssdp_response
+            
+        end_time = time.time() + time_limit
+        
+        while len(sockets) > 0:
+            time_remaining = end_time - time.time()
+            if time_remaining <= 0:
+                break
+                
+            readable = select.select(list(sockets.keys()), [], [], time_remaining)[0]
+            
+            for sock in readable:
+                for device in sockets[sock](sock):
+                    keys = set([device['host']])
+                    if device['uuid'] is not None:
+                        keys.add(device['uuid'].replace("-", "").lower())
+                        
+                    if keys & seen:
+                        continue
+                        
+                    seen.update(keys)
+                    
+                    print("chromecast found:", device['host'])
+                    yield device
+                    
+    finally:
+        for sock in sockets:
+            sock.close()
+            
+            
+            
+def discover_named_devices(time_limit=5, max_threads=NAME_RESOLVER_THREADS):
+    """ search the network like discover_devices, generating each device once its name is known. 
+        The names which weren't in the search responses are requested from the devices by a pool of threads, 
+        so slow or unresponsive devices don't hold up the others. Devices which don't give a name are skipped - 
+        these are usually other DIAL devices which answered the SSDP search, e.g. smart TVs """
+    
+    found = queue.Queue()
+    unnamed = queue.Queue()
+    stopped = threading.Event()
+    
+    def start_thread(target):
+        thread = threading.Thread(target=target)
+        thread.daemon = True
+        thread.start()
+        return thread
+        
+    def search():
+        """ search thread - passes the named devices straight on, and starts a name thread for each unnamed 
+            device, up to max_threads. None is put in the found queue when every thread has finished """
+            
+        threads = []
+        devices = discover_devices(time_limit=time_limit)
+        try:
+            for device in devices:
+                if stopped.is_set():
+                    break
+                    
+                if device['name']:
+                    found.put(device)
+                    continue
+                    
+                unnamed.put(device)
+                
+                if len(threads) < max_threads:
+                    threads.append(start_thread(resolve_names))
+        finally:
+            devices.close()
             
+            for thread in threads:
+                unnamed.put(None)
+            for thread in threads:
+                thread.join()
+                
+            found.put(None)
+            
+    def resolve_names():
+        """ name thread - request the name of each unnamed device until None is received """
+        
+        while True:
+            device = unnamed.get()
+            if device is None:
+                return
+                
+            if not stopped.is_set():
+                device['name'] = get_device_name(device['host'])
+                if device['name']:
+                    found.put(device)
+                
+    start_thread(search)
     
-    query = query_format % query_data
+    try:
+        while True:
+            try:
+                # the timeout lets ctrl-c interrupt the wait on Python 2
+                device = found.get(True, 1)
+            except queue.Empty:
+                continue
+                
+            if device is None:
+                return
+                
+            yield device
+    finally:
+        stopped.set()
+        
+        
+        
+def open_mdns_socket():
+    """ open a multicast socket and send the mDNS query for Cast devices """
     
+    query = cc_mdns.build_query(cc_mdns.CAST_SERVICE)
     
     # setup multicast socket    
     m_addr, m_port = ('224.0.0.251', 5353)
@@ -157,61 +276,111 @@ def search_network_mdns(device_limit=None, time_limit=5):
     sock.bind(('', m_port))
     sock.setsockopt(socket.SOL_IP, socket.IP_MULTICAST_IF, socket.inet_aton(intf) + socket.inet_aton('0.0.0.0'))
     sock.setsockopt(socket.SOL_IP, socket.IP_ADD_MEMBERSHIP, socket.inet_aton(m_addr) + socket.inet_aton('0.0.0.0'))
-
-    sock.settimeout(time_limit)
-
-
+    
+    sock.setblocking(0)
+    
     try:
-        print("Sending mDNS query")
         sock.sendto(query, 0, (m_addr, m_port))    
+    except:
+        sock.close()
+        raise
+        
+    return sock
+    
+    
+    
+def read_mdns_response(sock):
+    """ read an mDNS response - returns a list of the Cast devices in it """
+    
+    try:
+        data, addr = sock.recvfrom(9000)
+    except socket.error:
+        return []
+        
+    try:
+        return cc_mdns.get_cast_devices(data, addr[0])
+    except ValueError:
+        # not a valid DNS message
+        return []
+        
+        
+        
+def open_ssdp_socket():
+    """ open a socket and send the SSDP search for DIAL devices """
+    
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setblocking(0)
+    
+    req = "\r\n".join(['M-SEARCH * HTTP/1.1',
+                       'HOST: 239.255.255.250:1900',
+                       'MAN: "ssdp:discover"',
+                       'MX: 1',
+                       'ST: urn:dial-multiscreen-org:service:dial:1',
+                       '',''])
+                       
+    try:
+        sock.sendto(req.encode(), ("239.255.255.250", 1900))
+    except:
+        sock.close()
+        raise
+        
+    return sock
+    
+    
+    
+def read_ssdp_response(sock):
+    """ read an SSDP response - returns a list containing the device if it is a DIAL device """
+    
+    try:
+        data = sock.recv(1024).decode("utf-8", "replace")
+    except socket.error:
+        return []
+        
+    st, addr, udn = None, None, None
+    
+    for line in data.split("\r\n"):
+        line = line.replace(" ", "")
+    
+        if line.upper().startswith("LOCATION:"):
+            addr = urlparse(line[9:].strip()).hostname
+        
+        elif line.upper().startswith("ST:"):
+            st = line[3:].strip()
+            
+        elif line.upper().startswith("USN:UUID:"):
+            # the device UDN - the same as the mDNS id, but with dashes
+            udn = line[9:].split("::")[0]
 
-        while True:
-            try:
-                data, addr = sock.recvfrom(1024)
-                
-                # TODO parse the response properly, but for now this should identify chromecast responses
-                if query_data in data and "md=Chromecast" in data and addr[0] not in addrs:
-                    print("chromecast found:", addr[0])
-                    addrs.append(addr[0])
-                    
-                    if device_limit and len(addrs) == device_limit:
-                        print("enough devices found")
-                        break                    
-                                    
-            except socket.timeout:
-                break
-
-    finally:
-        sock.close()    
+    if addr is None or st != "urn:dial-multiscreen-org:service:dial:1":
+        return []
         
-    return addrs    
+    return [{'host':addr, 'port':None, 'name':None, 'uuid':udn, 'model':None, 'ttl':None}]
     
 
                                       
-def get_device_name(ip_addr):
+def get_device_name(ip_addr, timeout=NAME_REQUEST_TIMEOUT):
     """ get the device friendly name for an IP address """
     
+    conn = httplib.HTTPConnection(ip_addr, 8008, timeout=timeout)
     try:
-        conn = httplib.HTTPConnection(ip_addr + ":8008")
         conn.request("GET", "/setup/eureka_info?options=detail")
         resp = conn.getresponse()  
+        status_doc = resp.read()   
 
         if resp.status == 200:
-            status_doc = resp.read()   
             message = json.loads(status_doc) 
 
             return message['name']                         
    
         else:
             if resp.status == 404:
-                # eureka info not found, falling back to try SSDP description
+                # eureka info not found, falling back to try SSDP description - on the same connection
                 
-                conn = httplib.HTTPConnection(ip_addr + ":8008")
                 conn.request("GET", "/ssdp/device-desc.xml")
                 resp = conn.getresponse()
+                status_doc = resp.read()
                 
                 if resp.status == 200:
-                    status_doc = resp.read()
                     try:
                         xml = ElementTree.fromstring(status_doc)
 
@@ -221,64 +390,203 @@ def get_device_name(ip_addr):
 
                     except ElementTree.ParseError:
                         return "" 
-            else:
-                return "" 
+                        
+            return "" 
     except:
         # unable to get a name - this might be for many reasons 
         # e.g. a non chromecast device on the network that responded to the search
         return "" 
+    finally:
+        conn.close()
         
         
         
 
-def check_cache(name):
-    """ check the search results cache file """ 
-    
-    result = None
+def load_cache():
+    """ read the list of cached devices - a cache in the old tab separated format is converted """
     
     filepath = os.path.expanduser(CACHE_FILE)
     try:
         with open(filepath, "r") as f:
-            for line in f.readlines():
-                if "\t" in line:
-                    line_split = line.strip().split("\t", 1)
-                    if len(line_split) > 1:
-                        hostname, host = line_split
-                        if name == hostname:
-                            # name is found - check that the host responds with the same name
-                            device_name = get_device_name(host)
-                            print("Device name response: " + device_name)
-                            if name == device_name and device_name != "":
-                                result = host
-                                break
+            cache_data = f.read()
     except IOError:
-        pass
+        return []
+        
+    try:
+        cache = json.loads(cache_data)
+    except ValueError:
+        # old format: hostname[tab]ip_addr
+        devices = []
+        for line in cache_data.splitlines():
+            line_split = line.strip().split("\t", 1)
+            if len(line_split) > 1:
+                devices.append({'name':line_split[0], 'host':line_split[1], 'port':None, 'uuid':None, 'model':None, 
+                                'ttl':None, 'last_seen':None})
+        return devices
         
-    return result
+    if not isinstance(cache, dict) or cache.get('version') != CACHE_VERSION:
+        return []
+        
+    return cache.get('devices', [])
+    
+    
+    
+def find_cached_device(devices, name=None, uuid=None, host=None):
+    """ returns the cached device with the name, uuid or ip address, or None """
+    
+    for key, value in (('uuid', uuid), ('name', name), ('host', host)):
+        if value is None:
+            continue
+            
+        for device in devices:
+            if device.get(key) == value:
+                return device
+            
+    return None
+    
+    
+    
+def probe_device(host, port=None, timeout=PROBE_TIMEOUT):
+    """ returns True if the device accepts a connection to its Cast port """
+    
+    try:
+        sock = socket.create_connection((host, port or 8009), timeout)
+        sock.close()
+        return True
+    except socket.error:
+        return False
+        
+        
+        
+def check_cache(name):
+    """ check the search results cache file - returns the device ip address, or None if it isn't cached 
+        or doesn't respond """ 
+    
+    device = find_cached_device(load_cache(), name=name)
+    if device is None:
+        return None
+        
+    # a device seen within its mDNS ttl is assumed to be there, otherwise check that it is still on the network
+    last_seen = device.get('last_seen')
+    if last_seen is not None and device.get('ttl') and time.time() < last_seen + device['ttl']:
+        return device['host']
+        
+    if probe_device(device['host'], device.get('port')):
+        return device['host']
+        
+    return None
     
     
 
-def save_cache(host_map):
-    """ save the search results for quick access later """
+class CacheLock():
+    """ An exclusive lock on a cache file, held while it is updated - the device cache file unless another is given """
+    
+    def __init__(self, cache_file=CACHE_FILE):
+        self.cache_file = cache_file
+        
+    def __enter__(self):
+        self.lock_file = open(os.path.expanduser(self.cache_file) + ".lock", "a")
+        if fcntl is not None:
+            fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_EX)
+        return self
+        
+    def __exit__(self, exc_type, exc_value, traceback):
+        # closing the file releases the lock
+        self.lock_file.close()
+        
+        
+        
+def save_cache(found_devices):
+    """ save the search results for quick access later - the devices are added to the devices already cached.
+        The file is replaced in one step, so it is never seen half written """
     
     filepath = os.path.expanduser(CACHE_FILE)
-    with open(filepath, "w") as f:
-        for key in host_map:
-            if len(key) > 0 and len(host_map[key]) > 0:
-                # file format: hostname[tab]ip_addr
-                f.write(key + "\t" + host_map[key] + "\n")
+    now = time.time()
+    
+    with CacheLock():
+        devices = load_cache()
+        
+        for found_device in found_devices:
+            if not found_device.get('name'):
+                continue
+                
+            # a found device replaces any cached device with the same uuid, name or ip address
+            devices = [device for device in devices 
+                       if not (found_device['uuid'] is not None and device.get('uuid') == found_device['uuid'])
+                       and device.get('name') != found_device['name'] 
+                       and device.get('host') != found_device['host']]
+                       
+            devices.append({'name':found_device['name'],
+                            'host':found_device['host'],
+                            'port':found_device['port'],
+                            'uuid':found_device['uuid'],
+                            'model':found_device['model'],
+                            'ttl':found_device['ttl'],
+                            'last_seen':now})
+            
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(filepath), prefix=".cc_device_cache")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump({'version':CACHE_VERSION, 'devices':devices}, f, indent=1)
+                f.flush()
+                os.fsync(f.fileno())
+                
+            os.rename(temp_path, filepath)
+        except:
+            os.remove(temp_path)
+            raise
     
             
             
+def query_browser(name=None, socket_path=None, timeout=BROWSER_TIMEOUT):
+    """ ask the device browser for the devices it has seen, optionally only those with the name.
+        returns a list of devices, or None if no browser is running """
+    
+    if not hasattr(socket, "AF_UNIX"):
+        return None
+        
+    request = json.dumps({'name':name}) + "\n"
+    
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(os.path.expanduser(socket_path or BROWSER_SOCKET))
+        sock.sendall(request.encode("utf-8"))
+        
+        response = b""
+        while not response.endswith(b"\n"):
+            data = sock.recv(4096)
+            if len(data) == 0:
+                break
+            response += data
+            
+        return json.loads(response.decode("utf-8"))['devices']
+    
+    except (socket.error, ValueError, KeyError, TypeError):
+        # no browser is running, or it didn't answer
+        return None
+    
+    finally:
+        sock.close()
+        
+        
+        
 def find_device(name=None, time_limit=6):    
     """ find the first device (quick) or search by name (slower)"""
     
+    # a running device browser already knows which devices are on the network
+    devices = [device for device in query_browser(name=name or None) or [] if device['name']]
+    if len(devices) > 0:
+        print("found device in browser: " + devices[0]['name'])
+        return devices[0]['host'], devices[0]['name']
+    
     if name is None or name == "":
         # no name specified so find the first device that responds
         print("searching the network for a Chromecast device")
-        hosts = search_network(device_limit=1)
-        if len(hosts) > 0:
-            return hosts[0], get_device_name(hosts[0])
+        devices = list(limit_devices(discover_named_devices(), 1))
+        if len(devices) > 0:
+            save_cache(devices)
+            return devices[0]['host'], devices[0]['name']
         else:
             return None, None
     else:
@@ -291,19 +599,24 @@ def find_device(name=None, time_limit=6):
         else:
             # no cached results found run a full network search
             print("searching the network for: " + name)
-            result_map = {}
+            found_devices = []
+            result = None
             
-            hosts = search_network(time_limit=time_limit)
-            for host in hosts:
-                device_name = get_device_name(host)
-                if device_name != "":
-                    result_map[device_name] = host
+            # stop searching as soon as the device is found
+            devices = discover_named_devices(time_limit=time_limit)
+            for device in devices:
+                found_devices.append(device)
+                    
+                if device['name'] == name:
+                    result = device['host']
+                    devices.close()
+                    break
                 
-            save_cache(result_map)
+            save_cache(found_devices)
             
-            if name in result_map:
+            if result is not None:
                 print("found device: " + name)
-                return result_map[name], name
+                return result, name
             else:
                 return None, None
 
@@ -0,0 +1,168 @@
+"""
+Controls a group of Chromecast devices at once.
+
+The pool keeps a persistent connection to each device, and runs each command on every device at the same time,
+so a command on a group takes about as long as it takes on the slowest device.
+
+version 0.1
+
+"""
+
+
+# Copyright (C) 2014-2016 Pat Carter
+#
+# This file is part of Stream2chromecast.
+#
+# Stream2chromecast is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Stream2chromecast is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Stream2chromecast.  If not, see <http://www.gnu.org/licenses/>.
+
+
+
+import threading
+
+from cc_media_controller import CCMediaController
+
+
+
+class DeviceError():
+    """ The result of a command which failed on a device """
+
+    def __init__(self, error):
+        self.error = error
+
+
+    def __str__(self):
+        return "error: %s" % (self.error,)
+
+
+
+
+class CCDevicePool():
+    def __init__(self, device_names=None):
+        """ initialise - the devices, by name or ip address, can be given now or added later """
+
+        # device name : CCMediaController with a persistent connection
+        self.controllers = {}
+        self.lock = threading.Lock()
+
+        if device_names:
+            self.add_devices(device_names)
+
+
+
+    def run_concurrently(self, func, items):
+        """ call func(item) for each item, each on its own thread.
+            returns a dict of item : result, or a DeviceError if func raised an error """
+
+        results = {}
+
+        def run(item):
+            try:
+                result = func(item)
+            except (Exception, SystemExit) as e:
+                # the controller calls sys.exit() when a device can't be found
+                result = DeviceError(e)
+
+            with self.lock:
+                results[item] = result
+
+        threads = []
+        for item in items:
+            thread = threading.Thread(target=run, args=(item,))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        for thread in threads:
+            thread.join()
+
+        return results
+
+
+
+    def add_devices(self, device_names):
+        """ find the devices and create a controller for each, at the same time.
+            returns a dict of device name : DeviceError for the devices which couldn't be found """
+
+        new_names = [name for name in device_names if name not in self.controllers]
+
+        results = self.run_concurrently(lambda name: CCMediaController(device_name=name, persistent=True), new_names)
+
+        errors = {}
+        for name, result in results.items():
+            if isinstance(result, DeviceError):
+                errors[name] = result
+            else:
+                self.controllers[name] = result
+
+        return errors
+
+
+
+    def get_device_names(self):
+        return list(self.controllers.keys())
+
+
+
+    def run_command(self, command, *args, **kwargs):
+        """ run a controller method on every device in the pool, or on the devices named in device_names,
+            at the same time. Returns when every device has responded, with a dict of device name : result.
+            A device which failed has a DeviceError as its result """
+
+        device_names = kwargs.get("device_names")
+        if device_names is None:
+            device_names = self.get_device_names()
+
+        errors = self.add_devices(device_names)
+
+        results = self.run_concurrently(lambda name: getattr(self.controllers[name], command)(*args),
+                                        [name for name in device_names if name not in errors])
+        results.update(errors)
+
+        return results
+
+
+
+    def pause(self, device_names=None):
+        """ pause every device """
+        return self.run_command("pause", device_names=device_names)
+
+
+    def play(self, device_names=None):
+        """ unpause every device """
+        return self.run_command("play", device_names=device_names)
+
+
+    def stop(self, device_names=None):
+        """ stop every device """
+        return self.run_command("stop", device_names=device_names)
+
+
+    def set_volume(self, level, device_names=None):
+        """ set the volume of every device - a float value in level for absolute level or "+" / "-" indicates up or down """
+        return self.run_command("set_volume", level, device_names=device_names)
+
+
+    def get_status(self, device_names=None):
+        """ returns a dict of device name : status """
+        return self.run_command("get_status", device_names=device_names)
+
+
+
+    def close(self):
+        """ close the connection to each device """
+
+        for controller in self.controllers.values():
+            controller.close_socket()
+
+        self.controllers = {}
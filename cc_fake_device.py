@@ -0,0 +1,951 @@
+"""
+A fake Chromecast for testing without a device.
+
+Runs the Cast channel (TLS, port 8009), the /setup/eureka_info & SSDP device description HTTP server (port 8008)
+and answers mDNS & SSDP searches, so stream2chromecast can find it and control it just like a real device.
+
+The Default Media Receiver app can be launched, and media loaded, paused, played, stopped & seeked,
+and the volume set. When media is loaded the fake device fetches the URL, optionally limited to a given rate,
+and reports the time to the first byte and the transfer rate. Playback finishes when the whole file has been fetched.
+
+    python cc_fake_device.py [-name <name>] [-ip <address>] [-port <cast port>] [-httpport <http port>]
+                             [-fetchrate <bytes per second>] [-nofetch] [-playtime <seconds>]
+                             [-certfile <cert.pem> -keyfile <key.pem>]
+
+With -nofetch the media URL isn't fetched, and playback finishes after -playtime seconds, if given.
+A self-signed certificate is created with the openssl command if none is given.
+
+version 0.1
+
+"""
+
+
+# Copyright (C) 2014-2016 Pat Carter
+#
+# This file is part of Stream2chromecast.
+#
+# Stream2chromecast is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Stream2chromecast is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Stream2chromecast.  If not, see <http://www.gnu.org/licenses/>.
+
+
+
+import sys
+import os
+import socket
+import ssl
+import json
+import time
+import uuid
+import struct
+import shutil
+import tempfile
+import threading
+import subprocess
+
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+
+try:
+    from urllib.request import urlopen
+except ImportError:
+    from urllib2 import urlopen
+
+import cc_message
+import cc_mdns
+from cc_media_controller import MEDIAPLAYER_APPID, NS_CONNECTION, NS_HEARTBEAT, NS_RECEIVER, NS_MEDIA
+
+
+CAST_PORT = 8009
+HTTP_PORT = 8008
+
+MDNS_ADDR, MDNS_PORT = ('224.0.0.251', 5353)
+MDNS_SERVICE = cc_mdns.CAST_SERVICE
+MDNS_TTL = 120
+
+SSDP_ADDR, SSDP_PORT = ('239.255.255.250', 1900)
+SSDP_SEARCH_TARGETS = ("urn:dial-multiscreen-org:service:dial:1", "ssdp:all")
+
+# seconds between the heartbeat PINGs sent to each sender
+PING_INTERVAL = 5
+
+# size of the reads made when fetching media
+FETCH_BLOCK_SIZE = 65536
+
+MEDIAPLAYER_NAME = "Default Media Receiver"
+
+# PAUSE, SEEK, STREAM_VOLUME & STREAM_MUTE
+SUPPORTED_MEDIA_COMMANDS = 15
+
+
+
+def create_certificate(cert_dir, common_name):
+    """ create a self-signed certificate & key with the openssl command, returns their paths """
+
+    certfile = os.path.join(cert_dir, "cert.pem")
+    keyfile = os.path.join(cert_dir, "key.pem")
+
+    with open(os.devnull, "w") as devnull:
+        subprocess.check_call(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "3650",
+                               "-subj", "/CN=" + common_name, "-keyout", keyfile, "-out", certfile],
+                              stdout=devnull, stderr=devnull)
+
+    return certfile, keyfile
+
+
+
+def format_dns_record(name, record_type, rdata, ttl=MDNS_TTL, cache_flush=False):
+    """ format a DNS resource record """
+
+    record_class = 1
+    if cache_flush:
+        record_class |= 0x8000
+
+    return cc_mdns.encode_name(name) + struct.pack(">HHIH", record_type, record_class, ttl, len(rdata)) + rdata
+
+
+
+
+class Playback():
+    """ Media loaded on the fake device - fetches the media URL on a thread, and keeps track of the play position """
+
+    def __init__(self, device, media_session_id, media):
+        self.device = device
+        self.media_session_id = media_session_id
+        self.media = media
+
+        self.player_state = "BUFFERING"
+        self.idle_reason = None
+
+        # position at the last state change, and when it happened
+        self.position = 0.0
+        self.position_time = time.time()
+
+        self.bytes_fetched = 0
+        self.stopped = False
+        self.condition = threading.Condition(device.lock)
+
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+
+
+    def start(self):
+        self.thread.start()
+
+
+    def get_current_time(self):
+        """ the play position in seconds """
+
+        if self.player_state == "PLAYING":
+            return self.position + time.time() - self.position_time
+
+        return self.position
+
+
+    def set_state(self, player_state, idle_reason=None):
+        """ change the player state - call with the device lock held """
+
+        self.position = self.get_current_time()
+        self.position_time = time.time()
+
+        self.player_state = player_state
+        self.idle_reason = idle_reason
+
+        if player_state == "IDLE":
+            self.stopped = True
+
+        self.condition.notify_all()
+
+
+    def seek(self, position):
+        """ move the play position - call with the device lock held """
+
+        self.position = position
+        self.position_time = time.time()
+
+        self.condition.notify_all()
+
+
+    def get_status(self):
+        """ the MEDIA_STATUS entry for the media """
+
+        status = {"mediaSessionId":self.media_session_id,
+                  "playbackRate":1,
+                  "playerState":self.player_state,
+                  "currentTime":self.get_current_time(),
+                  "supportedMediaCommands":SUPPORTED_MEDIA_COMMANDS,
+                  "volume":self.device.volume,
+                  "media":self.media}
+
+        if self.idle_reason is not None:
+            status["idleReason"] = self.idle_reason
+
+        return status
+
+
+    def finish(self, idle_reason):
+        """ playback has ended - tell the senders, unless it has already been stopped """
+
+        with self.device.lock:
+            if self.stopped:
+                return
+
+            self.set_state("IDLE", idle_reason)
+            self.device.broadcast_media_status()
+
+
+    def wait_while_paused(self):
+        """ wait until playback is resumed, returns False if it has been stopped """
+
+        with self.device.lock:
+            while self.player_state == "PAUSED" and not self.stopped:
+                self.condition.wait()
+
+            return not self.stopped
+
+
+    def start_playing(self):
+        with self.device.lock:
+            if self.player_state == "BUFFERING" and not self.stopped:
+                self.set_state("PLAYING")
+                self.device.broadcast_media_status()
+
+
+    def run(self):
+        """ fetch the media, or wait for the play time when the media isn't fetched """
+
+        if self.device.fetch:
+            self.fetch()
+        else:
+            self.start_playing()
+
+            play_time = self.device.play_time
+
+            with self.device.lock:
+                while not self.stopped and (play_time is None or self.get_current_time() < play_time):
+                    timeout = None
+                    if play_time is not None and self.player_state == "PLAYING":
+                        timeout = play_time - self.get_current_time()
+                    self.condition.wait(timeout)
+
+            self.finish("FINISHED")
+
+
+    def fetch(self):
+        """ fetch the media URL at no more than the fetch rate, like a device buffering the media """
+
+        url = self.media.get("contentId", "")
+        print("fetching " + url)
+
+        start_time = time.time()
+        first_byte_time = None
+
+        try:
+            response = urlopen(url, timeout=30)
+            try:
+                while self.wait_while_paused():
+                    data = response.read(FETCH_BLOCK_SIZE)
+                    if len(data) == 0:
+                        break
+
+                    if first_byte_time is None:
+                        first_byte_time = time.time()
+                        print("time to first byte: %.3fs" % (first_byte_time - start_time))
+                        self.start_playing()
+
+                    self.bytes_fetched += len(data)
+
+                    if self.device.fetch_rate:
+                        delay = start_time + float(self.bytes_fetched) / self.device.fetch_rate - time.time()
+                        if delay > 0:
+                            time.sleep(delay)
+            finally:
+                response.close()
+
+        except Exception as e:
+            print("media fetch failed: %s" % e)
+            self.finish("ERROR")
+            return
+
+        elapsed = time.time() - start_time
+        rate = self.bytes_fetched / max(elapsed, 0.001)
+        print("fetched %d bytes in %.3fs - %.0f bytes/sec" % (self.bytes_fetched, elapsed, rate))
+
+        self.finish("FINISHED")
+
+
+
+
+class CastConnection():
+    """ A sender's connection to the Cast channel """
+
+    def __init__(self, device, sock, address):
+        self.device = device
+        self.sock = sock
+        self.address = address
+        self.send_lock = threading.Lock()
+        self.closed = threading.Event()
+
+
+    def send(self, source_id, destination_id, namespace, msg):
+        """ send a message to the sender - errors are ignored as the reader thread will find the connection closed """
+
+        data = cc_message.format_message(source_id, destination_id, namespace, json.dumps(msg))
+
+        try:
+            with self.send_lock:
+                self.sock.sendall(data)
+        except (socket.error, ValueError):
+            pass
+
+
+    def send_pings(self):
+        """ heartbeat thread - PING the sender until the connection is closed """
+
+        while not self.closed.wait(PING_INTERVAL):
+            self.send("receiver-0", "sender-0", NS_HEARTBEAT, {"type":"PING"})
+
+
+    def receive_data(self, decoder, data):
+        """ feed received data to the decoder and handle each complete message - no message is held afterwards,
+            so the decoder can reuse its buffer """
+
+        decoder.feed(data)
+
+        for message in decoder.messages():
+            cast_message = cc_message.CastMessage(message)
+            try:
+                msg = json.loads(cast_message.payload_utf8)
+            except (TypeError, ValueError):
+                continue
+
+            self.device.handle_message(self, cast_message.source_id, cast_message.destination_id, cast_message.namespace, msg)
+
+
+    def run(self):
+        """ handle the messages from the sender until the connection is closed """
+
+        pinger = threading.Thread(target=self.send_pings)
+        pinger.daemon = True
+        pinger.start()
+
+        decoder = cc_message.MessageDecoder()
+
+        try:
+            while True:
+                data = self.sock.recv(4096)
+                if len(data) == 0:
+                    break
+
+                self.receive_data(decoder, data)
+
+        except (socket.error, ssl.SSLError, ValueError):
+            pass
+
+        finally:
+            self.closed.set()
+            self.device.remove_connection(self)
+
+            try:
+                self.sock.close()
+            except socket.error:
+                pass
+
+
+
+
+class EurekaRequestHandler(BaseHTTPRequestHandler):
+    """ Answers the device info requests made to port 8008 """
+
+    def do_GET(self):
+        device = self.server.device
+
+        if self.path.startswith("/setup/eureka_info"):
+            content_type = "application/json"
+            body = json.dumps(device.get_eureka_info()).encode("utf-8")
+
+        elif self.path.startswith("/ssdp/device-desc.xml"):
+            content_type = "application/xml"
+            body = device.get_device_description().encode("utf-8")
+
+        else:
+            self.send_error(404)
+            return
+
+        self.send_response(200)
+        self.send_header("Content-type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Application-URL", "http://%s:%d/apps" % (device.ip_addr, device.http_port))
+        self.end_headers()
+
+        self.wfile.write(body)
+
+
+    def log_message(self, format, *args):
+        pass
+
+
+
+class EurekaServer(ThreadingMixIn, HTTPServer):
+    """ The device info HTTP server """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+
+
+class FakeDevice():
+    """ A fake Chromecast running the Default Media Receiver """
+
+    def __init__(self, name="Fake Chromecast", ip_addr=None, cast_port=CAST_PORT, http_port=HTTP_PORT,
+                 fetch=True, fetch_rate=None, play_time=None, certfile=None, keyfile=None):
+        """ initialise - fetch_rate is in bytes per second, None for no limit """
+
+        self.name = name
+        self.uuid = str(uuid.uuid4())
+        self.ip_addr = ip_addr or self.get_ip_addr()
+
+        # the servers only listen on the address if one is given, so several fake devices can run on one machine
+        self.bind_addr = ip_addr or ""
+        self.cast_port = cast_port
+        self.http_port = http_port
+
+        self.fetch = fetch
+        self.fetch_rate = fetch_rate
+        self.play_time = play_time
+
+        self.certfile = certfile
+        self.keyfile = keyfile
+        self.cert_dir = None
+
+        self.lock = threading.RLock()
+        self.connections = []
+        self.sockets = []
+        self.http_server = None
+        self.mdns_sock = None
+        self.running = False
+
+        self.volume = {"level":1.0, "muted":False}
+        self.session_id = None
+        self.playback = None
+        self.media_session_id = 0
+
+        self.start_time = time.time()
+
+
+
+    def get_ip_addr(self):
+        """ the address to advertise if none is given """
+
+        try:
+            return socket.gethostbyname(socket.gethostname())
+        except socket.error:
+            return "127.0.0.1"
+
+
+
+    def start(self):
+        """ start the servers & responders, each on its own thread """
+
+        if self.certfile is None:
+            self.cert_dir = tempfile.mkdtemp(prefix="cc_fake_device")
+            self.certfile, self.keyfile = create_certificate(self.cert_dir, self.uuid)
+
+        self.running = True
+
+        ssl_context = ssl.SSLContext(getattr(ssl, "PROTOCOL_TLS_SERVER", ssl.PROTOCOL_SSLv23))
+        ssl_context.load_cert_chain(self.certfile, self.keyfile)
+
+        cast_sock = socket.socket()
+        cast_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        cast_sock.bind((self.bind_addr, self.cast_port))
+        cast_sock.listen(50)
+        self.sockets.append(cast_sock)
+        self.start_thread(self.serve_cast_channel, cast_sock, ssl_context)
+
+        self.http_server = EurekaServer((self.bind_addr, self.http_port), EurekaRequestHandler)
+        self.http_server.device = self
+        self.start_thread(self.http_server.serve_forever)
+
+        self.mdns_sock = self.open_multicast_socket(MDNS_ADDR, MDNS_PORT)
+        if self.mdns_sock is not None:
+            self.start_thread(self.serve_mdns, self.mdns_sock)
+
+            # announce the device, as a real device does when it joins the network
+            self.send_mdns_response(self.mdns_sock, self.get_mdns_response())
+
+        ssdp_sock = self.open_multicast_socket(SSDP_ADDR, SSDP_PORT)
+        if ssdp_sock is not None:
+            self.start_thread(self.serve_ssdp, ssdp_sock)
+
+        print("fake Chromecast '%s' running on %s - cast port %d, http port %d" % (self.name, self.ip_addr, self.cast_port, self.http_port))
+
+
+
+    def stop(self):
+        """ stop the servers, close every connection and remove the generated certificate """
+
+        self.running = False
+
+        if self.mdns_sock is not None:
+            # a goodbye, so browsers remove the device straight away
+            self.send_mdns_response(self.mdns_sock, self.get_mdns_response(ttl=0))
+            self.mdns_sock = None
+
+        with self.lock:
+            if self.playback is not None:
+                self.playback.set_state("IDLE", "CANCELLED")
+
+            connections = list(self.connections)
+
+        for connection in connections:
+            try:
+                connection.sock.shutdown(socket.SHUT_RDWR)
+            except (socket.error, ValueError):
+                pass
+
+        for sock in self.sockets:
+            sock.close()
+        self.sockets = []
+
+        if self.http_server is not None:
+            self.http_server.shutdown()
+            self.http_server.server_close()
+            self.http_server = None
+
+        if self.cert_dir is not None:
+            shutil.rmtree(self.cert_dir, ignore_errors=True)
+            self.cert_dir = None
+            self.certfile = None
+            self.keyfile = None
+
+
+
+    def start_thread(self, target, *args):
+        thread = threading.Thread(target=target, args=args)
+        thread.daemon = True
+        thread.start()
+
+
+
+    def open_multicast_socket(self, group_addr, port):
+        """ open a socket receiving a multicast group - returns None if it isn't possible, e.g. with no network """
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if hasattr(socket, "SO_REUSEPORT"):
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            sock.setsockopt(socket.SOL_IP, socket.IP_MULTICAST_TTL, 255)
+            sock.setsockopt(socket.SOL_IP, socket.IP_MULTICAST_LOOP, 1)
+            sock.bind(("", port))
+            sock.setsockopt(socket.SOL_IP, socket.IP_ADD_MEMBERSHIP, socket.inet_aton(group_addr) + socket.inet_aton("0.0.0.0"))
+        except socket.error as e:
+            print("unable to listen on %s:%d - %s" % (group_addr, port, e))
+            sock.close()
+            return None
+
+        self.sockets.append(sock)
+        return sock
+
+
+
+    # Cast channel
+
+    def serve_cast_channel(self, listen_sock, ssl_context):
+        """ accept connections from senders, each is handled on its own thread """
+
+        while self.running:
+            try:
+                sock, address = listen_sock.accept()
+            except socket.error:
+                break
+
+            try:
+                sock = ssl_context.wrap_socket(sock, server_side=True)
+            except (socket.error, ssl.SSLError):
+                sock.close()
+                continue
+
+            connection = CastConnection(self, sock, address)
+            with self.lock:
+                self.connections.append(connection)
+
+            self.start_thread(connection.run)
+
+
+
+    def remove_connection(self, connection):
+        with self.lock:
+            if connection in self.connections:
+                self.connections.remove(connection)
+
+
+
+    def send_status(self, connection, source_id, destination_id, namespace, msg, request_id):
+        """ reply to a request with a status message, and send the status to every other sender """
+
+        msg["requestId"] = request_id
+        connection.send(source_id, destination_id, namespace, msg)
+
+        msg = dict(msg, requestId=0)
+        for other in list(self.connections):
+            if other is not connection:
+                other.send(source_id, "*", namespace, msg)
+
+
+
+    def broadcast_media_status(self):
+        """ send the media status to every sender - call with the lock held """
+
+        msg = self.get_media_status()
+        msg["requestId"] = 0
+        for connection in list(self.connections):
+            connection.send(self.session_id or "receiver-0", "*", NS_MEDIA, msg)
+
+
+
+    def get_receiver_status(self):
+        """ the RECEIVER_STATUS message """
+
+        status = {"volume":self.volume}
+
+        if self.session_id is not None:
+            status["applications"] = [{"appId":MEDIAPLAYER_APPID,
+                                       "displayName":MEDIAPLAYER_NAME,
+                                       "sessionId":self.session_id,
+                                       "transportId":self.session_id,
+                                       "statusText":"Ready To Cast",
+                                       "isIdleScreen":False,
+                                       "namespaces":[{"name":NS_MEDIA}]}]
+        else:
+            status["applications"] = []
+
+        return {"type":"RECEIVER_STATUS", "status":status}
+
+
+
+    def get_media_status(self):
+        """ the MEDIA_STATUS message """
+
+        status = []
+        if self.playback is not None:
+            status.append(self.playback.get_status())
+
+        return {"type":"MEDIA_STATUS", "status":status}
+
+
+
+    def handle_message(self, connection, source_id, destination_id, namespace, msg):
+        """ handle a message from a sender """
+
+        msg_type = msg.get("type", "")
+        request_id = msg.get("requestId", 0)
+
+        if namespace == NS_HEARTBEAT:
+            if msg_type == "PING":
+                connection.send(destination_id, source_id, NS_HEARTBEAT, {"type":"PONG"})
+
+        elif namespace == NS_CONNECTION:
+            # virtual connections aren't tracked
+            pass
+
+        elif namespace == NS_RECEIVER:
+            with self.lock:
+                reply = self.handle_receiver_message(msg_type, msg)
+                if reply is not None:
+                    self.send_status(connection, destination_id, source_id, namespace, reply, request_id)
+
+        elif namespace == NS_MEDIA:
+            with self.lock:
+                if destination_id != self.session_id:
+                    return
+
+                reply = self.handle_media_message(msg_type, msg)
+                if reply is not None:
+                    self.send_status(connection, destination_id, source_id, namespace, reply, request_id)
+
+
+
+    def handle_receiver_message(self, msg_type, msg):
+        """ handle a receiver request, returns the reply - call with the lock held """
+
+        if msg_type == "GET_STATUS":
+            return self.get_receiver_status()
+
+        elif msg_type == "LAUNCH":
+            if msg.get("appId") != MEDIAPLAYER_APPID:
+                return {"type":"LAUNCH_ERROR", "reason":"NOT_FOUND"}
+
+            if self.session_id is None:
+                self.session_id = str(uuid.uuid4())
+                print("launched " + MEDIAPLAYER_NAME)
+
+            return self.get_receiver_status()
+
+        elif msg_type == "STOP":
+            self.stop_playback()
+            self.session_id = None
+            return self.get_receiver_status()
+
+        elif msg_type == "SET_VOLUME":
+            volume = msg.get("volume", {})
+            if "level" in volume:
+                self.volume["level"] = min(max(float(volume["level"]), 0.0), 1.0)
+            if "muted" in volume:
+                self.volume["muted"] = bool(volume["muted"])
+
+            print("volume: %.2f muted: %s" % (self.volume["level"], self.volume["muted"]))
+            return self.get_receiver_status()
+
+        return {"type":"INVALID_REQUEST", "reason":"INVALID_COMMAND"}
+
+
+
+    def handle_media_message(self, msg_type, msg):
+        """ handle a media request, returns the reply - call with the lock held """
+
+        if msg_type == "GET_STATUS":
+            return self.get_media_status()
+
+        elif msg_type == "LOAD":
+            self.stop_playback()
+
+            self.media_session_id += 1
+            self.playback = Playback(self, self.media_session_id, msg.get("media", {}))
+            self.playback.start()
+
+            print("loading " + self.playback.media.get("contentId", ""))
+            return self.get_media_status()
+
+        if self.playback is None or msg.get("mediaSessionId") != self.playback.media_session_id:
+            return {"type":"INVALID_REQUEST", "reason":"INVALID_MEDIA_SESSION_ID"}
+
+        if msg_type == "PAUSE":
+            if self.playback.player_state == "PLAYING":
+                self.playback.set_state("PAUSED")
+
+        elif msg_type == "PLAY":
+            if self.playback.player_state == "PAUSED":
+                self.playback.set_state("PLAYING")
+
+        elif msg_type == "STOP":
+            self.stop_playback()
+
+        elif msg_type == "SEEK":
+            self.playback.seek(float(msg.get("currentTime", 0)))
+
+        else:
+            return {"type":"INVALID_REQUEST", "reason":"INVALID_COMMAND"}
+
+        print("media: " + self.playback.player_state)
+        return self.get_media_status()
+
+
+
+    def stop_playback(self):
+        """ stop any media which is playing - call with the lock held """
+
+        if self.playback is not None and self.playback.player_state != "IDLE":
+            self.playback.set_state("IDLE", "CANCELLED")
+
+
+
+    # device info
+
+    def get_eureka_info(self):
+        return {"name":self.name,
+                "ssdp_udn":self.uuid,
+                "ip_address":self.ip_addr,
+                "uptime":time.time() - self.start_time,
+                "version":8,
+                "build_version":"1",
+                "cast_build_revision":"1.0.0",
+                "detail":{"manufacturer":"Google Inc.", "model_name":"Chromecast"}}
+
+
+
+    def get_device_description(self):
+        return "\n".join(['<?xml version="1.0"?>',
+                          '<root xmlns="urn:schemas-upnp-org:device-1-0">',
+                          '  <specVersion><major>1</major><minor>0</minor></specVersion>',
+                          '  <URLBase>http://%s:%d</URLBase>' % (self.ip_addr, self.http_port),
+                          '  <device>',
+                          '    <deviceType>urn:dial-multiscreen-org:device:dial:1</deviceType>',
+                          '    <friendlyName>%s</friendlyName>' % self.name.replace("&", "&amp;").replace("<", "&lt;"),
+                          '    <manufacturer>Google Inc.</manufacturer>',
+                          '    <modelName>Eureka Dongle</modelName>',
+                          '    <UDN>uuid:%s</UDN>' % self.uuid,
+                          '  </device>',
+                          '</root>',
+                          ''])
+
+
+
+    # discovery
+
+    def get_mdns_response(self, ttl=MDNS_TTL):
+        """ the mDNS response advertising the Cast service - PTR, SRV, TXT & A records. A ttl of 0 is a goodbye """
+
+        instance_name = "Chromecast-" + self.uuid.replace("-", "") + "." + MDNS_SERVICE
+        host_name = self.uuid + ".local"
+
+        txt_data = b""
+        for entry in ("id=" + self.uuid.replace("-", ""), "md=Chromecast", "fn=" + self.name, "ve=05", "ic=/setup/icon.png", "ca=4101", "st=0", "rs="):
+            entry = entry.encode("utf-8")
+            txt_data += struct.pack("B", len(entry)) + entry
+
+        records = [format_dns_record(MDNS_SERVICE, cc_mdns.TYPE_PTR, cc_mdns.encode_name(instance_name), ttl),
+                   format_dns_record(instance_name, cc_mdns.TYPE_SRV, struct.pack(">HHH", 0, 0, self.cast_port) + cc_mdns.encode_name(host_name), ttl, cache_flush=True),
+                   format_dns_record(instance_name, cc_mdns.TYPE_TXT, txt_data, ttl, cache_flush=True),
+                   format_dns_record(host_name, cc_mdns.TYPE_A, socket.inet_aton(self.ip_addr), ttl, cache_flush=True)]
+
+        # id, flags (response, authoritative), questions, answers, authority records, additional records
+        header = struct.pack(">HHHHHH", 0, 0x8400, 0, 1, 0, len(records) - 1)
+
+        return header + b"".join(records)
+
+
+
+    def send_mdns_response(self, sock, response, addr=None):
+        """ send a response to the mDNS group, and to the address of a one-shot query """
+
+        try:
+            sock.sendto(response, (MDNS_ADDR, MDNS_PORT))
+            if addr is not None and addr[1] != MDNS_PORT:
+                # a one-shot query, which expects a unicast reply
+                sock.sendto(response, addr)
+        except socket.error as e:
+            print("unable to send mDNS response: %s" % e)
+
+
+
+    def serve_mdns(self, sock):
+        """ answer mDNS queries for the Cast service """
+
+        service_name = cc_mdns.encode_name(MDNS_SERVICE)[:-1]
+
+        while self.running:
+            try:
+                data, addr = sock.recvfrom(9000)
+            except socket.error:
+                break
+
+            if len(data) < 12:
+                continue
+
+            flags = struct.unpack(">H", data[2:4])[0]
+            if flags & 0x8000 or service_name not in data:
+                # a response, or a query for another service
+                continue
+
+            self.send_mdns_response(sock, self.get_mdns_response(), addr)
+
+
+
+    def serve_ssdp(self, sock):
+        """ answer SSDP searches for DIAL devices """
+
+        while self.running:
+            try:
+                data, addr = sock.recvfrom(4096)
+            except socket.error:
+                break
+
+            lines = data.decode("utf-8", "replace").split("\r\n")
+            if not lines[0].upper().startswith("M-SEARCH"):
+                continue
+
+            search_target = None
+            for line in lines[1:]:
+                if line.upper().startswith("ST:"):
+                    search_target = line[3:].strip()
+
+            if search_target not in SSDP_SEARCH_TARGETS:
+                continue
+
+            response = "\r\n".join(["HTTP/1.1 200 OK",
+                                    "CACHE-CONTROL: max-age=1800",
+                                    "EXT:",
+                                    "LOCATION: http://%s:%d/ssdp/device-desc.xml" % (self.ip_addr, self.http_port),
+                                    "ST: urn:dial-multiscreen-org:service:dial:1",
+                                    "USN: uuid:%s::urn:dial-multiscreen-org:service:dial:1" % self.uuid,
+                                    "", ""])
+
+            try:
+                sock.sendto(response.encode("utf-8"), addr)
+            except socket.error as e:
+                print("unable to send SSDP response: %s" % e)
+
+
+
+
+def get_named_arg_value(arg_name, args, convert=str):
+    """ get a command line named argument value, removing it from the args """
+
+    if arg_name not in args:
+        return None
+
+    arg_pos = args.index(arg_name)
+    args.pop(arg_pos)
+
+    if len(args) <= arg_pos:
+        sys.exit("a value is needed for " + arg_name)
+
+    try:
+        return convert(args.pop(arg_pos))
+    except ValueError:
+        sys.exit("invalid value for " + arg_name)
+
+
+
+def run():
+    """ run a fake device until interrupted """
+
+    args = sys.argv[1:]
+
+    fetch = "-nofetch" not in args
+    if not fetch:
+        args.remove("-nofetch")
+
+    device = FakeDevice(name=get_named_arg_value("-name", args) or "Fake Chromecast",
+                        ip_addr=get_named_arg_value("-ip", args),
+                        cast_port=get_named_arg_value("-port", args, int) or CAST_PORT,
+                        http_port=get_named_arg_value("-httpport", args, int) or HTTP_PORT,
+                        fetch=fetch,
+                        fetch_rate=get_named_arg_value("-fetchrate", args, int),
+                        play_time=get_named_arg_value("-playtime", args, float),
+                        certfile=get_named_arg_value("-certfile", args),
+                        keyfile=get_named_arg_value("-keyfile", args))
+
+    if len(args) > 0:
+        sys.exit(__doc__)
+
+    device.start()
+
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        device.stop()
+
+
+
+if __name__ == "__main__":
+    run()
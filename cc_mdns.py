@@ -0,0 +1,283 @@
+"""
+Builds mDNS queries and parses mDNS responses.
+
+Supports DNS name compression and decodes PTR, SRV, TXT, A & AAAA records -
+enough to find Cast devices and read their name, id, model & port from a single response.
+
+version 0.1
+
+"""
+
+
+# Copyright (C) 2014-2016 Pat Carter
+#
+# This file is part of Stream2chromecast.
+#
+# Stream2chromecast is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Stream2chromecast is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Stream2chromecast.  If not, see <http://www.gnu.org/licenses/>.
+
+
+
+import socket
+import struct
+
+
+CAST_SERVICE = "_googlecast._tcp.local"
+
+TYPE_A = 1
+TYPE_PTR = 12
+TYPE_TXT = 16
+TYPE_AAAA = 28
+TYPE_SRV = 33
+
+CLASS_IN = 1
+
+# the top bit of a record's class is the mDNS cache-flush flag
+CLASS_MASK = 0x7fff
+
+FLAG_RESPONSE = 0x8000
+
+# limit on the compression pointers followed in one name, which stops a malformed packet causing a loop
+MAX_POINTERS = 32
+
+
+
+# Queries
+
+def encode_name(name):
+    """ encode a domain name as DNS labels """
+
+    data = b""
+    for label in name.split("."):
+        if len(label) > 0:
+            label = label.encode("utf-8")
+            data += struct.pack("B", len(label)) + label
+
+    return data + b"\x00"
+
+
+
+def build_query(name=CAST_SERVICE, record_type=TYPE_PTR):
+    """ build a query for one record type - by default for the Cast service """
+
+    # id, flags, questions, answers, authority records, additional records
+    header = struct.pack(">HHHHHH", 0, 0, 1, 0, 0, 0)
+
+    return header + encode_name(name) + struct.pack(">HH", record_type, CLASS_IN)
+
+
+
+
+# Responses
+
+def normalise_name(name):
+    """ DNS names are compared without case or a trailing dot """
+
+    return name.rstrip(".").lower()
+
+
+
+def read_name(data, offset):
+    """ read a possibly compressed name from the message data, returns the name & the offset after it """
+
+    labels = []
+    end_offset = None
+    pointers = 0
+
+    while True:
+        if offset >= len(data):
+            raise ValueError("truncated name")
+
+        length = data[offset]
+
+        if length & 0xc0 == 0xc0:
+            # a pointer to the rest of the name, elsewhere in the message
+            if offset + 1 >= len(data):
+                raise ValueError("truncated name pointer")
+
+            pointers += 1
+            if pointers > MAX_POINTERS:
+                raise ValueError("too many name pointers")
+
+            if end_offset is None:
+                end_offset = offset + 2
+
+            offset = ((length & 0x3f) << 8) | data[offset + 1]
+
+        elif length & 0xc0:
+            raise ValueError("invalid label type")
+
+        elif length == 0:
+            offset += 1
+            break
+
+        else:
+            offset += 1
+            if offset + length > len(data):
+                raise ValueError("truncated label")
+
+            labels.append(bytes(data[offset:offset + length]).decode("utf-8", "replace"))
+            offset += length
+
+    if end_offset is None:
+        end_offset = offset
+
+    return ".".join(labels), end_offset
+
+
+
+def parse_txt(rdata):
+    """ parse TXT record strings - returns a dict of key : value, keys are lower case """
+
+    values = {}
+
+    offset = 0
+    while offset < len(rdata):
+        length = rdata[offset]
+        entry = bytes(rdata[offset + 1:offset + 1 + length]).decode("utf-8", "replace")
+        offset += 1 + length
+
+        if len(entry) == 0:
+            continue
+
+        key, _, value = entry.partition("=")
+        values[key.lower()] = value
+
+    return values
+
+
+
+def parse_rdata(data, record_type, offset, length):
+    """ decode the data of a record - record types which aren't supported are returned as bytes """
+
+    rdata = data[offset:offset + length]
+
+    if record_type == TYPE_A and length == 4:
+        return socket.inet_ntoa(bytes(rdata))
+
+    elif record_type == TYPE_AAAA and length == 16:
+        return socket.inet_ntop(socket.AF_INET6, bytes(rdata))
+
+    elif record_type == TYPE_PTR:
+        return normalise_name(read_name(data, offset)[0])
+
+    elif record_type == TYPE_SRV:
+        if length < 7:
+            raise ValueError("truncated SRV record")
+
+        priority, weight, port = struct.unpack(">HHH", bytes(rdata[:6]))
+        target = normalise_name(read_name(data, offset + 6)[0])
+        return {"priority":priority, "weight":weight, "port":port, "target":target}
+
+    elif record_type == TYPE_TXT:
+        return parse_txt(rdata)
+
+    return bytes(rdata)
+
+
+
+def parse_message(data):
+    """ parse a DNS message. returns a dict containing the header id & flags, the questions
+        and a list of all the answer, authority & additional records.
+        Each record is a dict of name, type, class, ttl & data. Raises ValueError if the message is invalid """
+
+    data = bytearray(data)
+
+    if len(data) < 12:
+        raise ValueError("truncated header")
+
+    message_id, flags, question_count, answer_count, authority_count, additional_count = struct.unpack(">HHHHHH", bytes(data[:12]))
+    offset = 12
+
+    questions = []
+    for i in range(question_count):
+        name, offset = read_name(data, offset)
+        if offset + 4 > len(data):
+            raise ValueError("truncated question")
+
+        record_type, record_class = struct.unpack(">HH", bytes(data[offset:offset + 4]))
+        offset += 4
+
+        questions.append({"name":normalise_name(name), "type":record_type, "class":record_class & CLASS_MASK})
+
+    records = []
+    for i in range(answer_count + authority_count + additional_count):
+        name, offset = read_name(data, offset)
+        if offset + 10 > len(data):
+            raise ValueError("truncated record")
+
+        record_type, record_class, ttl, length = struct.unpack(">HHIH", bytes(data[offset:offset + 10]))
+        offset += 10
+
+        if offset + length > len(data):
+            raise ValueError("truncated record data")
+
+        records.append({"name":normalise_name(name),
+                        "type":record_type,
+                        "class":record_class & CLASS_MASK,
+                        "ttl":ttl,
+                        "data":parse_rdata(data, record_type, offset, length)})
+        offset += length
+
+    return {"id":message_id, "flags":flags, "questions":questions, "records":records}
+
+
+
+def get_cast_devices(data, sender_addr=None, include_goodbyes=False):
+    """ find the Cast devices advertised in an mDNS response.
+        returns a list of dicts of host, port, name, uuid, model, ttl & the service instance name - the name, uuid & model 
+        are None if the response has no TXT record for the device, and the host is the sender address if it has no 
+        A or AAAA record. A device leaving the network sends a goodbye with a ttl of 0 - these are skipped unless 
+        include_goodbyes is True """
+
+    message = parse_message(data)
+    if not message["flags"] & FLAG_RESPONSE:
+        return []
+
+    records_by_name = {}
+    for record in message["records"]:
+        records_by_name.setdefault((record["name"], record["type"]), []).append(record)
+
+    def get_record(name, record_type):
+        records = records_by_name.get((name, record_type))
+        if records:
+            return records[0]
+        return None
+
+    devices = []
+    for ptr in records_by_name.get((CAST_SERVICE, TYPE_PTR), []):
+        if ptr["ttl"] == 0 and not include_goodbyes:
+            continue
+
+        instance_name = ptr["data"]
+
+        device = {"host":sender_addr, "port":None, "name":None, "uuid":None, "model":None, "ttl":ptr["ttl"], 
+                  "instance":instance_name}
+
+        srv = get_record(instance_name, TYPE_SRV)
+        if srv is not None:
+            device["port"] = srv["data"]["port"]
+
+            address = get_record(srv["data"]["target"], TYPE_A) or get_record(srv["data"]["target"], TYPE_AAAA)
+            if address is not None:
+                device["host"] = address["data"]
+
+        txt = get_record(instance_name, TYPE_TXT)
+        if txt is not None:
+            device["name"] = txt["data"].get("fn")
+            device["uuid"] = txt["data"].get("id")
+            device["model"] = txt["data"].get("md")
+
+        devices.append(device)
+
+    return devices
@@ -26,25 +26,195 @@ version 0.2.1
 
 
 import socket, ssl
+import errno
 import json
 import sys
 import time
 import re
+import threading
+import traceback
 
 import cc_device_finder
 import cc_message
 
 
 MEDIAPLAYER_APPID = "CC1AD845"
+
+NS_CONNECTION = "urn:x-cast:com.google.cast.tp.connection"
+NS_HEARTBEAT = "urn:x-cast:com.google.cast.tp.heartbeat"
+NS_RECEIVER = "urn:x-cast:com.google.cast.receiver"
+NS_MEDIA = "urn:x-cast:com.google.cast.media"
+
+PONG_PAYLOAD = json.dumps({"type":"PONG"})
+
+# seconds to wait for the response to a request
+RESPONSE_TIMEOUT = 30
+
+# longest time spent waiting for a status message before checking for ctrl-c & a lost connection - 
+# nothing is sent to the device
+STATUS_WAIT_INTERVAL = 1
+
+# the device sends a PING every 5 seconds. While waiting for a status, a PING is sent to the device after this many 
+# seconds without a message, and the connection is treated as lost after three intervals with nothing received - 
+# a device which drops off the network may not close the connection
+HEARTBEAT_INTERVAL = 5
+HEARTBEAT_TIMEOUT = 3 * HEARTBEAT_INTERVAL
+
+CAST_PORT = 8009
+
+# seconds for which a status received from the device is reused rather than requested again.
+# The status is kept up to date between requests by the status messages the device sends when it changes
+STATUS_CACHE_TTL = 10
+
+# TLS context shared by every connection, created when first needed
+SSL_CONTEXT = None
+
+# the last TLS session with each host - reconnections resume the session rather than making a full handshake
+TLS_SESSIONS = {}
  
 
+
+def get_ssl_context():
+    """ returns the shared TLS context - the Chromecast uses a self-signed certificate, so it isn't verified """
+    
+    global SSL_CONTEXT
+    
+    if SSL_CONTEXT is None:
+        context = ssl.SSLContext(getattr(ssl, "PROTOCOL_TLS_CLIENT", ssl.PROTOCOL_SSLv23))
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+        SSL_CONTEXT = context
+        
+    return SSL_CONTEXT
+    
+    
+    
+def build_load_request(session_id, content_url, content_type, sub=None, sub_language=None):
+    """ build the LOAD request for the media player, with an optional subtitles track """
+    
+    data = {"type":"LOAD",
+            "sessionId":session_id,
+            "media":{
+                "contentId":content_url,
+                "streamType":"buffered",
+                "contentType":content_type,
+                },
+            "autoplay":True,
+            "currentTime":0,
+            "customData":{
+                "payload":{
+                    "title:":""
+                    }
+                }
+            }
+
+
+    if sub:        
+        if sub_language is None:
+            sub_language = "en-US"
+            
+        data["media"].update({
+                            "textTrackStyle":{
+                                'backgroundColor':'#FFFFFF00'
+                            },
+                            "tracks": [{"trackId": 1,
+                                        "trackContentId": sub,
+                                        "type": "TEXT",
+                                        "language": sub_language,
+                                        "subtype": "SUBTITLES",
+                                        "name": "Englishx",
+                                        "trackContentType": "text/vtt",
+                                       }],
+                            })
+        data["activeTrackIds"] = [1]
+            
+    return data
+    
+    
+    
+class ResponseFuture():
+    """ The pending response to a request, completed by the reader thread """
+    
+    def __init__(self, request_id, namespace, sock):
+        self.request_id = request_id
+        self.namespace = namespace
+        self.sock = sock
+        self.response = None
+        self.error = None
+        self.event = threading.Event()
+        
+        
+    def set_result(self, response):
+        """ complete the request with the response message """
+        self.response = response
+        self.event.set()
+        
+        
+    def set_error(self, error):
+        """ fail the request, e.g. because the connection was lost """
+        self.error = error
+        self.event.set()
+        
+        
+    def done(self):
+        """ returns True if the request has completed """
+        return self.event.is_set()
+        
+        
+    def result(self, timeout=RESPONSE_TIMEOUT):
+        """ wait for the response - returns an empty dict if no response arrives before the timeout """
+        self.event.wait(timeout)
+        
+        if self.error is not None:
+            raise self.error
+            
+        if self.response is None:
+            return {}
+            
+        return self.response
+
+
+
+
 class CCMediaController():
-    def __init__(self, device_name=None):
-        """ initialise """
+    def __init__(self, device_name=None, persistent=False, status_ttl=STATUS_CACHE_TTL):
+        """ initialise - if persistent is True the connection to the device is kept open between commands.
+            A received status is reused for status_ttl seconds """
         
         self.host = self.get_device(device_name)
+        self.status_ttl = status_ttl
 
         self.sock = None
+        self.persistent = persistent
+        
+        # seconds taken by the last TLS handshake, and whether it resumed an earlier session
+        self.handshake_time = None
+        self.session_reused = False
+        self.connected_destinations = set()
+        
+        self.reader_thread = None
+        self.pending_requests = {}
+        self.send_lock = threading.Lock()
+        
+        # message handlers - namespace : {message type : [handler functions]}
+        # messages on other namespaces are dropped without their payload being decoded, 
+        # unless they are responses to a request
+        self.handlers = {}
+        self.register_handler(NS_RECEIVER, "RECEIVER_STATUS", self.update_receiver_status_data)
+        self.register_handler(NS_MEDIA, "MEDIA_STATUS", self.update_media_status_data)
+        self.register_handler(NS_CONNECTION, "CLOSE", self.handle_close)
+        
+        # notified after each status message has been handled, and when the connection is lost
+        self.status_condition = threading.Condition()
+        for namespace, msg_type in ((NS_RECEIVER, "RECEIVER_STATUS"), (NS_MEDIA, "MEDIA_STATUS"), (NS_CONNECTION, "CLOSE")):
+            self.register_handler(namespace, msg_type, self.notify_status)
+        
+        # encoded PONG messages, keyed on the destination id
+        self.pong_messages = {}
+        
+        # when a message was last received from the device, and when a PING was last sent to it
+        self.last_message_time = None
+        self.last_ping_time = None
         
         self.request_id = 1
         self.source_id = "sender-0"
@@ -54,6 +224,15 @@ class CCMediaController():
         self.volume_status = None
         self.current_applications = None
         
+        # the media player app session, remembered between commands on a persistent connection
+        self.session_id = None
+        self.transport_id = None
+        self.media_session_id = None
+        
+        # when the receiver & media status were last received on the current connection
+        self.receiver_status_time = None
+        self.media_status_time = None
+        
     
     
     def get_device(self, device_name):
@@ -81,110 +260,409 @@ class CCMediaController():
         
         
     def open_socket(self):
-        """ open a socket if there is not currently one open """
+        """ open a socket if there is not currently one open, and start a thread reading from it """
         
         if self.sock is None:
-            self.sock = socket.socket()
-            self.sock = ssl.wrap_socket(self.sock)
-
-            self.sock.connect((self.host,8009))
+            # a device which has dropped off the network doesn't refuse the connection, so it would never fail
+            sock = socket.create_connection((self.host, CAST_PORT), RESPONSE_TIMEOUT)
+            
+            # session resumption needs Python 3.6 or later
+            wrap_args = {}
+            session = TLS_SESSIONS.get(self.host)
+            if session is not None:
+                wrap_args['session'] = session
+            
+            start_time = time.time()
+            try:
+                self.sock = get_ssl_context().wrap_socket(sock, **wrap_args)
+                self.sock.settimeout(None)
+            except:
+                sock.close()
+                raise
+                
+            self.handshake_time = time.time() - start_time
+            self.session_reused = getattr(self.sock, "session_reused", False)
+            
+            self.connected_destinations = set()
+            self.last_message_time = time.time()
+            self.last_ping_time = None
+            
+            self.reader_thread = threading.Thread(target=self.read_messages, args=(self.sock,))
+            self.reader_thread.daemon = True
+            self.reader_thread.start()
 
                 
     def close_socket(self):
         """ close the socket if there is one open """
         
-        if self.sock is not None:
-            self.sock.close()
-            
+        sock = self.sock
+        reader_thread = self.reader_thread
+        
         self.sock = None
+        self.reader_thread = None
+        self.connected_destinations = set()
+        self.expire_status()
+        
+        if sock is not None:
+            # a TLS 1.3 session ticket is sent after the handshake, so the session is saved when the socket is closed
+            self.save_tls_session(sock)
+            
+            # shutting down the socket wakes the reader thread up
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except (socket.error, ValueError):
+                pass
+                
+            if reader_thread is not None and reader_thread is not threading.current_thread():
+                reader_thread.join(1)
+                
+            sock.close()
+        
+        
+    def save_tls_session(self, sock):
+        """ remember the TLS session for resuming on the next connection to the host """
+        
+        session = getattr(sock, "session", None)
+        if session is not None:
+            TLS_SESSIONS[self.host] = session
+            
+            
+    def end_command(self):
+        """ close the socket at the end of a command, unless the connection is persistent """
+        
+        if not self.persistent:
+            self.close_socket()
+            
+            
+    def run_command(self, command, *args):
+        """ run a command, reconnecting & retrying once if a persistent connection has dropped """
+        
+        try:
+            return command(*args)
+        except socket.error:
+            if not self.persistent:
+                raise
+                
+            print("connection to the device lost - reconnecting")
+            self.close_socket()
+            self.clear_session()
+            
+        return command(*args)
+        
+        
+    def clear_session(self):
+        """ forget the remembered media player app session """
+        
+        if self.transport_id is not None:
+            self.connected_destinations.discard(self.transport_id)
+            
+        self.session_id = None
+        self.transport_id = None
+        self.media_session_id = None
+        self.media_status = None
+        self.media_status_time = None
+        
+        
+        
+    def expire_status(self):
+        """ forget when the status was received, so it is requested again - 
+            status changes can't be received without a connection """
+        
+        self.receiver_status_time = None
+        self.media_status_time = None
+        
+        
+        
+    def is_status_fresh(self, status_time):
+        """ returns True if a status received at status_time can be reused """
+        
+        return status_time is not None and time.time() - status_time < self.status_ttl
 
 
 
-    def send_data(self, namespace, data_dict):
+    def send_data(self, namespace, data_dict, destination_id=None):
         """ send data to the device in binary format"""
         
+        if destination_id is None:
+            destination_id = self.destination_id
+        
         data = json.dumps(data_dict)
         
         #print "Sending: ", namespace, data
         
-        msg = cc_message.format_message(self.source_id, self.destination_id, namespace, data)
+        msg = cc_message.format_message(self.source_id, destination_id, namespace, data)
+        
+        sock = self.sock
+        if sock is None:
+            raise socket.error(errno.ENOTCONN, "not connected to the device")
         
-        self.sock.write(msg)
+        with self.send_lock:
+            sock.sendall(msg)
 
         
         
-    def read_message(self):
-        """ read a complete message from the device """
-
-        data = b""
-        while len(data) < 4:
-            data += self.sock.recv(4)
+    def recv(self, sock, size):
+        """ receive data from the device, raising an error if the connection has been closed """
         
-        msg_length, data = cc_message.extract_length_header(data) 
-        while len(data) < msg_length:
-            data += self.sock.recv(2048)
+        data = sock.recv(size)
+        if len(data) == 0:
+            raise socket.error(errno.ECONNRESET, "connection closed by the device")
             
-       
-        message_dict = cc_message.extract_message(data)
+        return data
         
-        message = {}
         
+        
+    def read_messages(self, sock):
+        """ reader thread - handle every message from the device until the connection is closed.
+            An error in a message handler is printed without closing the connection """
+        
+        decoder = cc_message.MessageDecoder()
+        
+        error = None
         try:
-            message = json.loads(message_dict['data'].decode())
-        except:
-            pass
+            while True:
+                self.receive_data(decoder, self.recv(sock, 4096))
+        except (socket.error, ssl.SSLError, ValueError) as e:
+            # a closed connection, or a message which can't be decoded so the stream can't be followed
+            error = e
+        finally:
+            self.end_reader(sock, error)
+            
+            
+            
+    def receive_data(self, decoder, data):
+        """ feed received data to the decoder and dispatch each complete message.
+            No message is held once this returns, so the decoder can reuse its buffer for the next data """
         
-        #print message_dict['namespace']
-        #print json.dumps(message, indent=4, separators=(',', ': '))
+        decoder.feed(data)
         
-        return message   
+        for message in decoder.messages():
+            self.dispatch_message(message)
+            
+            
+            
+    def end_reader(self, sock, error):
+        """ fail the requests waiting on a connection which has been lost, and forget the connection """
         
-         
-    
-    def get_response(self, request_id):
-        """ get the response matching the original request id """
+        if not isinstance(error, socket.error):
+            error = socket.error(errno.ECONNRESET, "connection to the device lost: %s" % error)
+            
+        # fail any requests still waiting for a response on this connection
+        for request_id, future in list(self.pending_requests.items()):
+            if future.sock is sock:
+                self.pending_requests.pop(request_id, None)
+                future.set_error(error)
+                
+        if self.sock is sock:
+            self.sock = None
+            self.reader_thread = None
+            self.connected_destinations = set()
+            self.expire_status()
+            self.save_tls_session(sock)
+            sock.close()
+            
+        self.notify_status()
+            
+            
+            
+    def register_handler(self, namespace, msg_type, handler):
+        """ call handler(msg) for each message of the type received on the namespace """
         
-        resp = {}
+        self.handlers.setdefault(namespace, {}).setdefault(msg_type, []).append(handler)
         
-        count = 0
-        while len(resp) == 0:
-            msg = self.read_message()
+        
+        
+    def unregister_handler(self, namespace, msg_type, handler):
+        """ stop calling a handler added with register_handler """
+        
+        handlers = self.handlers.get(namespace, {}).get(msg_type, [])
+        if handler in handlers:
+            handlers.remove(handler)
+            
             
-            msg_type = msg.get("type", msg.get("responseType", ""))
             
-            if msg_type == "PING":
-                data = {"type":"PONG"}
-                namespace = "urn:x-cast:com.google.cast.tp.heartbeat"
-                self.send_data(namespace, data) 
+    def dispatch_message(self, data):
+        """ pass a message from the device to the handlers for its namespace & type, 
+            and to the request waiting for it """
+        
+        self.last_message_time = time.time()
+        
+        cast_message = cc_message.CastMessage(data)
+        
+        # heartbeats are answered without decoding the payload
+        if cast_message.get_raw_field("namespace") == NS_HEARTBEAT.encode():
+            if b'"PING"' in bytes(cast_message.get_raw_field("payload_utf8") or b""):
+                self.send_pong(cast_message.source_id)
+            return
+            
+        namespace = cast_message.namespace
+        
+        namespace_handlers = self.handlers.get(namespace)
+        if namespace_handlers is None:
+            if namespace not in [future.namespace for future in list(self.pending_requests.values())]:
+                return
+            namespace_handlers = {}
+        
+        try:
+            msg = json.loads(cast_message.payload_utf8)
+        except (TypeError, ValueError):
+            return
+            
+        if not isinstance(msg, dict):
+            # valid JSON, but not a message object
+            return
+            
+        #print namespace
+        #print json.dumps(msg, indent=4, separators=(',', ': '))
+        
+        msg_type = msg.get("type", msg.get("responseType", ""))
+        
+        for handler in list(namespace_handlers.get(msg_type, [])):
+            try:
+                handler(msg)
+            except Exception:
+                # a bug in a handler doesn't affect the connection or the other handlers
+                print("error handling %s message on %s" % (msg_type, namespace))
+                traceback.print_exc()
+            
+        if "requestId" in msg:
+            future = self.pending_requests.pop(msg['requestId'], None)
+            if future is not None:
+                future.set_result(msg)
                 
-                # if 30 ping/pong messages are received without a response to the request_id, 
-                # assume no response is coming
-                count += 1
-                if count == 30:
-                    return resp
                 
-            elif msg_type == "RECEIVER_STATUS":
-                self.update_receiver_status_data(msg)
                 
-            elif msg_type == "MEDIA_STATUS":
-                self.update_media_status_data(msg)
+    def notify_status(self, msg=None):
+        """ wake up any threads waiting for a status change """
+        
+        with self.status_condition:
+            self.status_condition.notify_all()
+            
+            
+            
+    def wait_for_status(self, predicate, timeout=None):
+        """ wait until predicate() returns True, checking it each time a status message is received.
+            returns False if the timeout expires first, raises socket.error if the connection is lost 
+            or the device stops responding """
+        
+        sock = self.sock
+        
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+            
+        responding = True
+        
+        with self.status_condition:
+            while not predicate():
+                if sock is None or self.sock is not sock:
+                    raise socket.error(errno.ECONNRESET, "connection to the device lost")
+                    
+                if not self.check_heartbeat():
+                    responding = False
+                    break
+                    
+                wait_time = STATUS_WAIT_INTERVAL
+                if deadline is not None:
+                    wait_time = min(wait_time, deadline - time.time())
+                    if wait_time <= 0:
+                        return False
+                        
+                self.status_condition.wait(wait_time)
+                
+        if not responding:
+            # closing the socket stops the reader thread, which is blocked on a connection the device won't close
+            self.close_socket()
+            raise socket.error(errno.ETIMEDOUT, "no response from the device")
+            
+        return True
+        
+        
+        
+    def check_heartbeat(self):
+        """ PING the device if nothing has been received from it for a heartbeat interval.
+            returns False if nothing has been received within the heartbeat timeout """
+        
+        silent_time = time.time() - self.last_message_time
+        
+        if silent_time > HEARTBEAT_TIMEOUT:
+            return False
+            
+        if silent_time > HEARTBEAT_INTERVAL and (self.last_ping_time is None or 
+                                                 time.time() - self.last_ping_time > HEARTBEAT_INTERVAL):
+            self.last_ping_time = time.time()
+            self.send_data(NS_HEARTBEAT, {"type":"PING"}, "receiver-0")
+            
+        return True
+        
+        
+        
+    def send_pong(self, destination_id):
+        """ answer a heartbeat PING with a PONG message which is only encoded once """
+        
+        msg = self.pong_messages.get(destination_id)
+        if msg is None:
+            msg = cc_message.format_message(self.source_id, destination_id, NS_HEARTBEAT, PONG_PAYLOAD)
+            self.pong_messages[destination_id] = msg
             
-            if "requestId" in msg and msg['requestId'] == request_id:
-                resp = msg
+        sock = self.sock
+        if sock is not None:
+            with self.send_lock:
+                sock.sendall(msg)
+                
                 
-        return resp
+                
+    def handle_close(self, msg):
+        """ the media player app has closed its connection """
+        
+        self.receiver_app_status = None
+        self.clear_session()
+         
+    
+    
+    def get_response(self, request_id):
+        """ get the response matching the original request id """
+        
+        future = self.pending_requests.get(request_id)
+        if future is None:
+            return {}
+            
+        try:
+            return future.result()
+        finally:
+            self.pending_requests.pop(request_id, None)
+            
+            
+            
+    def send_msg(self, namespace, data):
+        """ send a request to the device without waiting - returns a ResponseFuture for the response.
+            Several requests can be in flight at once """
+        
+        with self.send_lock:
+            self.request_id += 1
+            request_id = self.request_id
+            
+        data['requestId'] = request_id
+        
+        future = ResponseFuture(request_id, namespace, self.sock)
+        self.pending_requests[request_id] = future
+        
+        try:
+            self.send_data(namespace, data)
+        except:
+            self.pending_requests.pop(request_id, None)
+            raise
+            
+        return future
 
 
 
     def send_msg_with_response(self, namespace, data):
         """ send a request to the device and wait for a response matching the request id """
         
-        self.request_id += 1
-        data['requestId'] = self.request_id
-        
-        self.send_data(namespace, data)
+        future = self.send_msg(namespace, data)
         
-        return self.get_response(self.request_id)
+        return self.get_response(future.request_id)
 
             
         
@@ -192,6 +670,7 @@ class CCMediaController():
         """ update the status for the Media Player app if it is running """
         
         self.receiver_app_status = None
+        self.receiver_status_time = time.time()
         
         if 'status' in msg:
             status = msg['status']
@@ -204,6 +683,16 @@ class CCMediaController():
                         
             if 'volume' in status:
                 self.volume_status = status['volume']
+                
+        
+        # remember the app session, re-connecting to the transport if the session has changed
+        if self.receiver_app_status is None:
+            self.clear_session()
+            
+        elif self.receiver_app_status.get('sessionId') != self.session_id:
+            self.clear_session()
+            self.session_id = self.receiver_app_status.get('sessionId')
+            self.transport_id = str(self.receiver_app_status['transportId'])
                         
                         
                         
@@ -211,10 +700,12 @@ class CCMediaController():
         """ update the media status if there is any media loaded """
         
         self.media_status = None
+        self.media_status_time = time.time()
         
         status = msg.get("status", [])
         if len(status) > 0:  
             self.media_status = status[0] # status is an array - selecting the first result..?                 
+            self.media_session_id = self.media_status.get('mediaSessionId')
 
 
          
@@ -227,17 +718,23 @@ class CCMediaController():
                      
         self.destination_id = destination_id
         
+        # a virtual connection to each destination only needs to be made once per socket
+        if destination_id in self.connected_destinations:
+            return
+        
         data = {"type":"CONNECT","origin":{}}
-        namespace = "urn:x-cast:com.google.cast.tp.connection"
+        namespace = NS_CONNECTION
         self.send_data(namespace, data)
         
+        self.connected_destinations.add(destination_id)
+        
         
     
     def get_receiver_status(self):
         """ send a status request to the receiver """
         
         data = {"type":"GET_STATUS"}
-        namespace = "urn:x-cast:com.google.cast.receiver"
+        namespace = NS_RECEIVER
         self.send_msg_with_response(namespace, data)
                 
     
@@ -246,22 +743,45 @@ class CCMediaController():
         """ send a status request to the media player """
         
         data = {"type":"GET_STATUS"}
-        namespace = "urn:x-cast:com.google.cast.media"
+        namespace = NS_MEDIA
         self.send_msg_with_response(namespace, data)   
             
             
                     
+    def refresh_receiver_status(self):
+        """ request the receiver status unless it has been received recently """
+        
+        if not self.is_status_fresh(self.receiver_status_time):
+            self.get_receiver_status()
+            
+            
+            
+    def refresh_media_status(self):
+        """ request the media status unless it has been received recently """
+        
+        if not self.is_status_fresh(self.media_status_time):
+            self.get_media_status()
+            
+            
+            
     def load(self, content_url, content_type, sub, sub_language):
         """ Launch the player app, load & play a URL """
         
+        self.run_command(self.load_media, content_url, content_type, sub, sub_language)
+        
+        
+        
+    def load_media(self, content_url, content_type, sub, sub_language):
+        """ launch the player app if it isn't running and send the LOAD request """
+        
         self.connect("receiver-0")
 
-        self.get_receiver_status()
+        self.refresh_receiver_status()
         
         # we only set the receiver status for MEDIAPLAYER - so if it is set, the app is currenty running
         if self.receiver_app_status is None:
             data = {"type":"LAUNCH","appId":MEDIAPLAYER_APPID}
-            namespace = "urn:x-cast:com.google.cast.receiver"
+            namespace = NS_RECEIVER
             self.send_msg_with_response(namespace, data)
             
             # if there is still no receiver app status the launch failed.
@@ -275,108 +795,82 @@ class CCMediaController():
 
         self.connect(transport_id)
 
-        data = {"type":"LOAD",
-                "sessionId":session_id,
-                "media":{
-                    "contentId":content_url,
-                    "streamType":"buffered",
-                    "contentType":content_type,
-                    },
-                "autoplay":True,
-                "currentTime":0,
-                "customData":{
-                    "payload":{
-                        "title:":""
-                        }
-                    }
-                }
-
-
-        if sub:        
-            if sub_language is None:
-                sub_language = "en-US"
-                
-            data["media"].update({
-                                "textTrackStyle":{
-                                    'backgroundColor':'#FFFFFF00'
-                                },
-                                "tracks": [{"trackId": 1,
-                                            "trackContentId": sub,
-                                            "type": "TEXT",
-                                            "language": sub_language,
-                                            "subtype": "SUBTITLES",
-                                            "name": "Englishx",
-                                            "trackContentType": "text/vtt",
-                                           }],
-                                })
-            data["activeTrackIds"] = [1]
-
-        
-        namespace = "urn:x-cast:com.google.cast.media"
+        data = build_load_request(session_id, content_url, content_type, sub, sub_language)
+        
+        namespace = NS_MEDIA
         resp = self.send_msg_with_response(namespace, data)
 
 
-        # wait for the player to return "BUFFERING", "PLAYING" or "IDLE"
-        if resp.get("type", "") == "MEDIA_STATUS":            
-            player_state = ""
-            while player_state != "PLAYING" and player_state != "IDLE" and player_state != "BUFFERING":
-                time.sleep(2)        
-                
-                self.get_media_status()
+        # wait for the player to report "BUFFERING", "PLAYING" or "IDLE" - the device sends the status as it changes
+        if resp.get("type", "") == "MEDIA_STATUS":
+            self.wait_for_status(self.player_has_started, RESPONSE_TIMEOUT)
                 
-                if self.media_status is not None:
-                    player_state = self.media_status.get("playerState", "")
-
                 
-        self.close_socket()       
+        self.end_command()       
 
 
             
     def control(self, command, parameters=None):
         """ send a control command to the player """
+        
+        self.run_command(self.send_control, command, parameters)
+        
+        
+        
+    def send_control(self, command, parameters=None):
+        """ find the current media session and send it the command """
           
         if parameters is None:
             parameters = {}
+            
+        # a status received recently on a persistent connection is reused without asking for it again
         self.connect("receiver-0")
 
-        self.get_receiver_status()
+        self.refresh_receiver_status()
         
         if self.receiver_app_status is None:
             print("No media player app running")
-            self.close_socket()
+            self.end_command()
             return      
         
-        transport_id = str(self.receiver_app_status['transportId'])       
+        self.connect(self.transport_id)
         
-        self.connect(transport_id)
-        
-        self.get_media_status()
+        self.refresh_media_status()
+            
         
         media_session_id = 1
-        if self.media_status is not None:
-            media_session_id = self.media_status['mediaSessionId']
+        if self.media_session_id is not None:
+            media_session_id = self.media_session_id
                                                                      
         data = {"type":command, "mediaSessionId":media_session_id}
         data.update(parameters)  # for additional parameters
         
-        namespace = "urn:x-cast:com.google.cast.media"
+        namespace = NS_MEDIA
         self.send_msg_with_response(namespace, data)
         
-        self.close_socket()
+        self.end_command()
                        
     
     
     def get_status(self):
         """ get the receiver and media status """
         
+        return self.run_command(self.read_status)
+        
+        
+        
+    def read_status(self):
+        """ request the receiver status, and the media status if the player app is running """
+        
         self.connect("receiver-0")
 
         self.get_receiver_status()
         
         if self.receiver_app_status is not None:   
-            transport_id = str(self.receiver_app_status['transportId']) 
-            self.connect(transport_id)
+            self.connect(self.transport_id)
             self.get_media_status()
+        else:
+            self.media_status = None
         
         application_list = []
         if self.current_applications is not None:
@@ -392,7 +886,7 @@ class CCMediaController():
                   'client':self.sock.getsockname(),
                   'applications':application_list}
                 
-        self.close_socket()
+        self.end_command()
         
         return status
         
@@ -401,16 +895,58 @@ class CCMediaController():
     def is_idle(self):
         """ return the IDLE state of the player """
         
-        status = self.get_status()
+        self.get_status()
+        
+        return self.player_is_idle()
+        
         
-        if status['media_status']  is None:
-            if status['receiver_status'] is None:
+        
+    def player_is_idle(self):
+        """ return the IDLE state of the player from the last status received """
+        
+        if self.media_status is None:
+            if self.receiver_app_status is None:
                 return True
             else:    
-                return status['receiver_status'].get("statusText", "") == "Ready To Cast"
+                return self.receiver_app_status.get("statusText", "") == "Ready To Cast"
 
         else:    
-            return status['media_status'].get("playerState", "") == "IDLE"
+            return self.media_status.get("playerState", "") == "IDLE"
+            
+            
+            
+    def player_has_started(self):
+        """ returns True once the loaded media is buffering or playing, or has already finished """
+        
+        if self.media_status is None:
+            return False
+            
+        return self.media_status.get("playerState", "") in ("BUFFERING", "PLAYING", "IDLE")
+        
+        
+        
+    def wait_for_idle(self):
+        """ wait until the player is idle, e.g. when playback has finished.
+            On a persistent connection this waits for the status messages sent by the device as the player state 
+            changes. Otherwise the status is requested every second """
+        
+        if not self.persistent:
+            while not self.is_idle():
+                time.sleep(1)
+            return
+            
+        self.run_command(self.wait_idle)
+        
+        
+        
+    def wait_idle(self):
+        """ read the status if it isn't known, then wait for the player to become idle """
+        
+        if self.sock is None or self.transport_id is None or self.transport_id not in self.connected_destinations:
+            # the transport must be connected to receive its status messages
+            self.read_status()
+            
+        self.wait_for_status(self.player_is_idle)
        
        
 
@@ -433,10 +969,17 @@ class CCMediaController():
     def set_volume(self, level):
         """ set the receiver volume - a float value in level for absolute level or "+" / "-" indicates up or down"""
         
+        self.run_command(self.send_volume, level)
+        
+        
+        
+    def send_volume(self, level):
+        """ send the SET_VOLUME request, reading the current level first for a relative change """
+        
         self.connect("receiver-0")
 
         if level in ("+", "-"):
-            self.get_receiver_status()
+            self.refresh_receiver_status()
         
             if self.volume_status is not None:
                 curr_level = self.volume_status['level']
@@ -447,10 +990,10 @@ class CCMediaController():
             
         
         data = {"type":"SET_VOLUME", "volume":{"muted":False, "level":level} }
-        namespace = "urn:x-cast:com.google.cast.receiver"
+        namespace = NS_RECEIVER
         self.send_msg_with_response(namespace, data)  
         
-        self.close_socket() 
+        self.end_command() 
         
         
         
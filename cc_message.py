@@ -29,7 +29,38 @@ Thanks to TheCrazyT for this very helpful gist : https://gist.github.com/TheCraz
 
 
 
-from struct import pack, unpack
+from struct import pack, unpack, unpack_from
+
+
+# the Cast protocol limits messages to 64KB
+MAX_MESSAGE_LENGTH = 65536
+
+# encoded message fields preceding the payload, keyed on (source_id, destination_id, namespace, payload type)
+HEADER_CACHE = {}
+HEADER_CACHE_SIZE = 256
+
+# protocol buffers wire types
+WIRE_TYPE_VARINT = 0
+WIRE_TYPE_64BIT = 1
+WIRE_TYPE_LENGTH_DELIMITED = 2
+WIRE_TYPE_32BIT = 5
+
+# CastMessage payload types
+PAYLOAD_TYPE_STRING = 0
+PAYLOAD_TYPE_BINARY = 1
+
+# CastMessage fields - field number : (name, wire type, python type)
+CAST_MESSAGE_FIELDS = {
+    1: ("protocol_version", WIRE_TYPE_VARINT, int),
+    2: ("source_id", WIRE_TYPE_LENGTH_DELIMITED, str),
+    3: ("destination_id", WIRE_TYPE_LENGTH_DELIMITED, str),
+    4: ("namespace", WIRE_TYPE_LENGTH_DELIMITED, str),
+    5: ("payload_type", WIRE_TYPE_VARINT, int),
+    6: ("payload_utf8", WIRE_TYPE_LENGTH_DELIMITED, str),
+    7: ("payload_binary", WIRE_TYPE_LENGTH_DELIMITED, bytes),
+}
+
+CAST_MESSAGE_FIELD_NUMBERS = dict([(name, field_number) for field_number, (name, wire_type, field_type) in CAST_MESSAGE_FIELDS.items()])
 
 
 # Sent messages
@@ -59,8 +90,8 @@ def format_varint_value(int_value):
 def format_int_field(field_number, field_data):
     """ formats a protocol buffers Int field """
     
-    field =  pack("B", format_field_id(field_number, 0))   #  0 = Int field type    
-    field += pack("B", field_data)  
+    field =  format_varint_value(format_field_id(field_number, 0))   #  0 = Int field type    
+    field += format_varint_value(field_data)  
     
     return field 
     
@@ -69,11 +100,14 @@ def format_int_field(field_number, field_data):
 def format_string_field(field_number, field_data):
     """ formats a protocol buffers length-delimited field """
     
+    if not isinstance(field_data, bytes):
+        field_data = field_data.encode("utf-8")
+    
     field_data_len = format_varint_value(len(field_data))
     
-    field =  pack("B", format_field_id(field_number, 2))   #  2 = Length-delimited field type  
+    field =  format_varint_value(format_field_id(field_number, 2))   #  2 = Length-delimited field type  
     field += pack("%ds" % len(field_data_len), field_data_len)
-    field += pack("%ds" % len(field_data), field_data.encode())
+    field += pack("%ds" % len(field_data), field_data)
     
     return field  
     
@@ -86,20 +120,47 @@ def prepend_length_header(msg):
     
     
     
-def format_message(source_id, destination_id, namespace, data):    
-    """ formats a message to be sent to the Chromecast """
+def format_message_header(source_id, destination_id, namespace, payload_type=PAYLOAD_TYPE_STRING):
+    """ returns the encoded fields which precede the payload, up to the payload field id.
+        These are the same for every message with the same source, destination & namespace, so they are cached """
+    
+    key = (source_id, destination_id, namespace, payload_type)
+    
+    header = HEADER_CACHE.get(key)
+    if header is None:
+        payload_field = CAST_MESSAGE_FIELD_NUMBERS["payload_utf8"]
+        if payload_type == PAYLOAD_TYPE_BINARY:
+            payload_field = CAST_MESSAGE_FIELD_NUMBERS["payload_binary"]
+            
+        header = b""
+        header += format_int_field(1, 0)   # Protocol Version  =  0
+        header += format_string_field(2, source_id)
+        header += format_string_field(3, destination_id)
+        header += format_string_field(4, namespace)
+        header += format_int_field(5, payload_type)
+        header += format_varint_value(format_field_id(payload_field, WIRE_TYPE_LENGTH_DELIMITED))
+        
+        if len(HEADER_CACHE) >= HEADER_CACHE_SIZE:
+            HEADER_CACHE.clear()
+            
+        HEADER_CACHE[key] = header
+        
+    return header
+    
+    
+    
+def format_message(source_id, destination_id, namespace, data, payload_type=PAYLOAD_TYPE_STRING):    
+    """ formats a message to be sent to the Chromecast. 
+        Binary payloads are sent with payload_type = PAYLOAD_TYPE_BINARY """
     
-    msg = b""
-    msg += format_int_field(1, 0)   # Protocol Version  =  0
-    msg += format_string_field(2, source_id)
-    msg += format_string_field(3, destination_id)
-    msg += format_string_field(4, namespace)
-    msg += format_int_field(5, 0)   # payload type : string  =  0
-    msg += format_string_field(6, data)
+    header = format_message_header(source_id, destination_id, namespace, payload_type)
     
-    msg = prepend_length_header(msg)        
+    if not isinstance(data, bytes):
+        data = data.encode("utf-8")
+        
+    data_len = format_varint_value(len(data))
     
-    return msg
+    return b"".join((pack(">I", len(header) + len(data_len) + len(data)), header, data_len, data))
     
     
     
@@ -130,64 +191,232 @@ def extract_field_id(data):
     return byte >> 3, (byte & 7)    
     
     
+
+def extract_varint(data):
+    """ extracts a varint from the start of the data, returns the value and the remaining data """
     
-def extract_int_field(data):
-    """ extracts a protocol buffers Int field from a received message """
+    value, pos = decode_varint(get_byte_view(data), 0)
+    return value, data[pos:]
     
-    field_id = extract_field_id(data[0:1])
-    int_value = unpack("B", data[1:2])[0]
     
-    remainder = ""
-    if len(data) > 2:
-        remainder = data[2:]
     
-    return field_id, int_value, remainder
+def get_byte_view(data):
+    """ returns a view of the data whose items are integers. On Python 3 this is a memoryview, so nothing is copied """
     
-
-def extract_varint(data):
-    # extract varint
-    # LSB first
-    value = 0
-    ptr = 0
-    mul = 1
-    while True:
-        byte = unpack("B", data[ptr])[0]
-        value += mul * (byte & 127)
-        ptr += 1
-        if not byte & 128:
-            break
-        mul *= 128
-
-    remainder = data[ptr:]
-    return value, remainder
+    if bytes is str:
+        # Python 2 - memoryview items are strings
+        return bytearray(data)
         
+    return memoryview(data)
+    
     
-def extract_string_field(data):
-    """ extracts a protocol buffers length-delimited field from a received message """
     
-    field_id = extract_field_id(data[0])    
-    data = data[1:]
+def decode_varint(view, pos):
+    """ decodes a varint starting at pos, returns the value and the position after it """
     
-    # extract varint length
-    length, data = extract_varint(data)
-    string = data[:length]
-    remainder = data[length:]        
-    return field_id, string, remainder
+    value = 0
+    shift = 0
+    while True:
+        if pos >= len(view):
+            raise ValueError("truncated varint")
+            
+        byte = view[pos]
+        pos += 1
+        
+        value |= (byte & 127) << shift
+        if not byte & 128:
+            return value, pos
+            
+        shift += 7
+        
+        
+        
+class CastMessage():
+    """ A received CastMessage protocol buffer.
+    
+        The fields may appear in any order, and fields which aren't part of CastMessage are skipped.
+        Only the positions of the fields are found when the message is created - the string & binary fields 
+        are copied & decoded the first time they are accessed, so payloads which aren't needed are never decoded. """
+    
+    def __init__(self, data):
+        self.view = get_byte_view(data)
+        self.int_fields = {}
+        self.field_positions = {}
+        self.decoded_fields = {}
+        
+        view = self.view
+        pos = 0
+        while pos < len(view):
+            key, pos = decode_varint(view, pos)
+            field_number = key >> 3
+            wire_type = key & 7
+            
+            if wire_type == WIRE_TYPE_VARINT:
+                value, pos = decode_varint(view, pos)
+                self.int_fields[field_number] = value
+                
+            elif wire_type == WIRE_TYPE_LENGTH_DELIMITED:
+                length, pos = decode_varint(view, pos)
+                if pos + length > len(view):
+                    raise ValueError("truncated field %d" % field_number)
+                self.field_positions[field_number] = (pos, pos + length)
+                pos += length
+                
+            elif wire_type == WIRE_TYPE_64BIT:
+                pos += 8
+                
+            elif wire_type == WIRE_TYPE_32BIT:
+                pos += 4
+                
+            else:
+                raise ValueError("unsupported wire type %d for field %d" % (wire_type, field_number))
+                
+        if pos > len(view):
+            raise ValueError("truncated message")
+            
+            
+    def __getattr__(self, name):
+        """ decode a CastMessage field by name the first time it is accessed """
+        
+        field_number = CAST_MESSAGE_FIELD_NUMBERS.get(name)
+        if field_number is None:
+            raise AttributeError(name)
+            
+        field_name, wire_type, field_type = CAST_MESSAGE_FIELDS[field_number]
+        
+        if wire_type == WIRE_TYPE_VARINT:
+            return self.int_fields.get(field_number, 0)
+            
+        if field_number not in self.decoded_fields:
+            value = self.get_raw_field(name)
+            if value is not None:
+                value = bytes(value)
+                if field_type is str and bytes is not str:
+                    value = value.decode("utf-8")
+                    
+            self.decoded_fields[field_number] = value
+            
+        return self.decoded_fields[field_number]
+        
+        
+    def get_raw_field(self, name):
+        """ returns the undecoded data of a string or binary field without copying it, or None if it isn't present.
+            e.g. to compare the namespace with a bytes value without decoding it """
+        
+        positions = self.field_positions.get(CAST_MESSAGE_FIELD_NUMBERS[name])
+        if positions is None:
+            return None
+            
+        start, end = positions
+        return self.view[start:end]
+        
+        
+    def has_field(self, name):
+        """ returns True if the field was present in the message """
+        
+        field_number = CAST_MESSAGE_FIELD_NUMBERS[name]
+        return field_number in self.int_fields or field_number in self.field_positions
+        
+        
+    @property
+    def payload(self):
+        """ the string or binary payload, depending on the payload type """
+        
+        if self.payload_type == PAYLOAD_TYPE_BINARY:
+            return self.payload_binary
+            
+        return self.payload_utf8
     
     
     
 def extract_message(data):
     """ extracts the message data from a Chromecast response message """
     
+    message = CastMessage(data)
+    
     resp = {}
+    resp['protocol'] = message.protocol_version
+    resp['source_id'] = bytes(message.get_raw_field("source_id") or b"")
+    resp['destination_id'] = bytes(message.get_raw_field("destination_id") or b"")
+    resp['namespace'] = bytes(message.get_raw_field("namespace") or b"")
+    resp['payload_type'] = message.payload_type
     
-    field_id, resp['protocol'], data = extract_int_field(data)
-    field_id, resp['source_id'], data = extract_string_field(data)
-    field_id, resp['destination_id'], data = extract_string_field(data)
-    field_id, resp['namespace'], data = extract_string_field(data)
-    field_id, resp['payload_type'], data = extract_int_field(data)
-    field_id, resp['data'], data = extract_string_field(data)
+    payload_field = "payload_utf8"
+    if message.payload_type == PAYLOAD_TYPE_BINARY:
+        payload_field = "payload_binary"
+    resp['data'] = bytes(message.get_raw_field(payload_field) or b"")
     
     return resp
-
     
+    
+    
+class MessageDecoder():
+    """ Splits a stream of received data into complete messages.
+    
+        Data can arrive in chunks of any size, from a blocking socket or an asyncio protocol. It is collected 
+        in a single reusable buffer and each complete message is returned as a memoryview of that buffer, 
+        without the length header, so no data is copied when messages are split out. 
+        A message can be held (e.g. by a CastMessage) after more data is fed - the buffer is never changed 
+        underneath a memoryview which is still in use. """
+    
+    def __init__(self):
+        self.buffer = bytearray()
+        self.pos = 0
+        
+        # the number of times the buffer had to be copied because a message was still held when data was fed
+        self.buffer_copies = 0
+        
+        
+    def feed(self, data):
+        """ add received data to the buffer """
+        
+        try:
+            # discard the messages which have already been returned
+            if self.pos > 0:
+                del self.buffer[:self.pos]
+                self.pos = 0
+                
+            self.buffer += data
+            
+        except BufferError:
+            # a memoryview of an earlier message is still in use, so the buffer can't be resized - start a new one
+            self.buffer = bytearray(memoryview(self.buffer)[self.pos:]) + data
+            self.pos = 0
+            self.buffer_copies += 1
+            
+            
+    def next_message(self):
+        """ returns the next complete message as a memoryview, or None if more data is needed """
+        
+        available = len(self.buffer) - self.pos
+        if available < 4:
+            return None
+            
+        length = unpack_from(">I", self.buffer, self.pos)[0]
+        if length > MAX_MESSAGE_LENGTH:
+            raise ValueError("message length %d exceeds the maximum of %d" % (length, MAX_MESSAGE_LENGTH))
+            
+        if available < 4 + length:
+            return None
+            
+        start = self.pos + 4
+        self.pos = start + length
+        
+        return memoryview(self.buffer)[start:self.pos]
+        
+        
+    def messages(self):
+        """ generates each complete message in the buffer """
+        
+        while True:
+            message = self.next_message()
+            if message is None:
+                return
+                
+            yield message
+            
+            
+    def pending(self):
+        """ returns the number of buffered bytes which don't yet make up a complete message """
+        
+        return len(self.buffer) - self.pos
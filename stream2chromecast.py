@@ -30,11 +30,12 @@ version: 0.6.3
 VERSION = "0.6.3"
 
 
-import sys, os, errno
+import sys, os, errno, stat
 import re
 import signal
 
 from cc_media_controller import CCMediaController
+from cc_device_pool import CCDevicePool
 import cc_device_finder
 import time
 
@@ -49,7 +50,8 @@ except ImportError:
 
 
 import mimetypes
-from threading import Thread
+from threading import Thread, Condition
+from collections import deque
 
 import subprocess
 try:
@@ -59,9 +61,20 @@ except ImportError:
     import BaseHTTPServer
     import httplib
 
+try:
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from SocketServer import ThreadingMixIn
+
 import socket
 
 import tempfile
+import json
+
+try:
+    from shutil import which as find_executable
+except ImportError:
+    from distutils.spawn import find_executable
 
 
 
@@ -120,6 +133,11 @@ Additional option to specify an Chromecast device by name (or ip address) explic
     %s -devicename <chromecast device name> <file>
     
     
+Control or get the status of a group of devices at once by giving -devicename for each device:
+    e.g. to pause two devices
+    %s -devicename "Living Room" -devicename Kitchen -pause
+    
+    
 Additional option to specify the preferred transcoder tool when both ffmpeg & avconv are available
     e.g. to play and transcode a file using avconv
     %s -transcoder avconv -transcode <file>
@@ -159,45 +177,153 @@ Additional option to specify the buffer size of the data returned from the trans
     e.g. to specify a buffer size of 5 megabytes
     %s -transcode -transcodebufsize 5242880 <file>
     
-""" % ((script_name,) * 21)
+""" % ((script_name,) * 22)
 
 
 
 
 PIDFILE = os.path.join(tempfile.gettempdir(), "stream2chromecast_%s.pid") 
 
-FFMPEG = 'ffmpeg %s -i "%s" -preset ultrafast -f mp4 -frag_duration 3000 -b:v 2000k -loglevel error %s -'
-AVCONV = 'avconv %s -i "%s" -preset ultrafast -f mp4 -frag_duration 3000 -b:v 2000k -loglevel error %s -'
+TRANSCODER_CACHE_FILE = "~/.cc_transcoder_cache"
+
+# the mimetype & probe results of media files, keyed on the file path and kept while the size & modification time 
+# are unchanged - so a file is only probed once however many times it is played
+MEDIA_CACHE_FILE = "~/.cc_media_cache"
+MEDIA_CACHE_SIZE = 256
+
+# commands which can control a group of devices at once
+GROUP_COMMANDS = ("-stop", "-pause", "-continue", "-status", "-setvol", "-volup", "-voldown", "-mute")
+
+FFMPEG = 'ffmpeg %s -i "%s" %s -f mp4 -frag_duration 3000 -loglevel error %s -'
+AVCONV = 'avconv %s -i "%s" %s -f mp4 -frag_duration 3000 -loglevel error %s -'
+
+# transcoder codec options for each stream type, depending on whether the stream can be copied as it is
+VIDEO_COPY_OPTIONS = "-c:v copy"
+VIDEO_TRANSCODE_OPTIONS = "-preset ultrafast -b:v 2000k"
+AUDIO_COPY_OPTIONS = "-c:a copy"
+AUDIO_TRANSCODE_OPTIONS = ""
+
+# encoders to use, in order of preference, when the transcoder reports that they are available.
+# A hardware encoder can be listed without the hardware or driver being present, so each video encoder
+# is only used after a trial encode of one frame has succeeded
+H264_ENCODERS = ("libx264", "h264_nvenc", "h264_omx", "h264_v4l2m2m", "h264_videotoolbox")
+AAC_ENCODERS = ("libfdk_aac", "aac")
+VIDEO_ENCODER_OPTIONS = {"libx264":"-preset ultrafast -b:v 2000k"}
+VIDEO_BITRATE_OPTIONS = "-b:v 2000k"
+
+# streams which the Chromecast can play without transcoding, so they only need remuxing into mp4
+COPY_VIDEO_CODECS = ("h264",)
+COPY_VIDEO_PROFILES = ("constrained baseline", "baseline", "main", "high")
+COPY_VIDEO_MAX_LEVEL = 41
+COPY_VIDEO_PIXEL_FORMATS = ("yuv420p", "yuvj420p")
+COPY_AUDIO_CODECS = ("aac", "mp3")
+
+# number of bytes read from the start of a file to identify its container format
+SNIFF_SIZE = 4096
+
+# read size used when the file body is copied or chunked
+CHUNK_SIZE = 65536
+
+# maximum number of bytes handed to a single sendfile call
+SENDFILE_BLOCK_SIZE = 8388608
+
+# size of the blocks read from the transcoder output
+TRANSCODE_BLOCK_SIZE = 65536
+
+# capacity of the transcoder output buffer when -transcodebufsize isn't specified
+TRANSCODE_BUFFER_SIZE = 4194304
+
+
+
+def get_cpu_time():
+    """ return the user + system cpu time used by this process """
+    times = os.times()
+    return times[0] + times[1]
+    
+    
+    
+def report_transfer(method, bytes_sent, elapsed, cpu_time):
+    """ display the throughput and cpu cost of a completed transfer """
+    megabytes = bytes_sent / 1048576.0
+    gigabytes = bytes_sent / 1073741824.0
+    
+    throughput = 0
+    if elapsed > 0:
+        throughput = megabytes / elapsed
+        
+    cpu_per_gb = 0
+    if gigabytes > 0:
+        cpu_per_gb = cpu_time / gigabytes
+        
+    print("sent %.1f MB in %.1fs using %s: %.1f MB/s, %.2f cpu seconds per GB" % (megabytes, elapsed, method, throughput, cpu_per_gb))
+
+
+
+class MediaServer(ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """ Serve each connection in its own thread for the whole playback session """
+    daemon_threads = True
+    allow_reuse_address = True
 
 
 
 class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
     content_type = "video/mp4"
+    protocol_version = "HTTP/1.1"
+    
+    # the only file (or URL for transcoding) which is served - any other path is refused, 
+    # as the server can be reached by every host on the network for the whole playback
+    allowed_path = None
     
     """ Handle HTTP requests for files which do not need transcoding """
     
     def do_GET(self):
         
-        query = self.path.split("?",1)[-1]
-        filepath = unquote_plus(query)
-        
         self.suppress_socket_error_report = None
         
-        self.send_headers(filepath)       
+        filepath = self.get_filepath()
+        if filepath is None:
+            return
+        
+        if not self.send_headers(filepath):
+            return
         
         print("sending data")
         try: 
             self.write_response(filepath)
         except socket.error as e:
-            if isinstance(e.args, tuple):
-                if e[0] in (errno.EPIPE, errno.ECONNRESET):
-                   print("disconnected")
-                   self.suppress_socket_error_report = True
-                   return
+            if e.errno in (errno.EPIPE, errno.ECONNRESET):
+                print("disconnected")
+                self.suppress_socket_error_report = True
+                self.close_connection = True
+                return
             
             raise
 
 
+    def do_HEAD(self):
+        
+        filepath = self.get_filepath()
+        if filepath is None:
+            return
+        
+        self.send_headers(filepath)
+
+
+    def get_filepath(self):
+        """ return the file path requested in the query string, or send a 404 response and return None 
+            if it isn't the file being cast """
+        query = self.path.split("?",1)[-1]
+        filepath = unquote_plus(query)
+        
+        if self.allowed_path is None or filepath != self.allowed_path:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return None
+            
+        return filepath
+
+
     def handle_one_request(self):
         try:
             return BaseHTTPServer.BaseHTTPRequestHandler.handle_one_request(self)
@@ -214,56 +340,349 @@ class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
                 raise
 
 
+    def get_file_size(self, filepath):
+        """ return the size of a regular file, or None if the length of the response can't be known in advance """
+        try:
+            file_stat = os.stat(filepath)
+        except OSError:
+            return None
+            
+        if not stat.S_ISREG(file_stat.st_mode):
+            return None
+            
+        return file_stat.st_size
+
+
+    def get_byte_range(self, file_size):
+        """ parse a single range from the Range header into an (offset, length) tuple.
+            returns None if the whole file should be sent, or False if the range can't be satisfied """
+        range_header = self.headers.get("Range")
+        if range_header is None:
+            return None
+            
+        units, _, range_spec = range_header.strip().partition("=")
+        if units.strip().lower() != "bytes" or "," in range_spec:
+            # multiple ranges aren't supported - the whole file is sent instead
+            return None
+            
+        first, _, last = range_spec.strip().partition("-")
+        try:
+            if first == "":
+                # suffix range e.g. "bytes=-500" for the final 500 bytes
+                suffix_length = int(last)
+                if suffix_length == 0:
+                    return False
+                offset = max(file_size - suffix_length, 0)
+                end = file_size - 1
+            else:
+                offset = int(first)
+                end = file_size - 1
+                if last != "":
+                    end = min(int(last), file_size - 1)
+        except ValueError:
+            return None
+            
+        if offset >= file_size or end < offset:
+            return False
+            
+        return offset, end - offset + 1
+
+
     def send_headers(self, filepath):
-        self.protocol_version = "HTTP/1.1"
-        self.send_response(200)
+        """ send the response headers, returns False if no response body should follow """
+        
+        # regular files are sent with a Content-Length, anything else (pipes, devices etc.) is sent chunked
+        file_size = self.get_file_size(filepath)
+        
+        self.content_length = file_size
+        self.range_offset = 0
+        
+        byte_range = None
+        if file_size is not None:
+            byte_range = self.get_byte_range(file_size)
+            
+        if byte_range is False:
+            self.send_response(416)
+            self.send_header("Content-Range", "bytes */%d" % file_size)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return False
+        
+        if byte_range is not None:
+            self.range_offset, self.content_length = byte_range
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes %d-%d/%d" % (self.range_offset, self.range_offset + self.content_length - 1, file_size))
+        else:
+            self.send_response(200)
+            
         self.send_header("Content-type", self.content_type)
         self.send_header('Access-Control-Allow-Origin', '*')
-        self.send_header("Transfer-Encoding", "chunked")
-        self.end_headers()    
+        if self.content_length is not None:
+            self.send_header("Accept-Ranges", "bytes")
+            self.send_header("Content-Length", str(self.content_length))
+        else:
+            self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        
+        return True
 
 
     def write_response(self, filepath):
-        with open(filepath, "rb") as f:           
+        start_time = time.time()
+        start_cpu = get_cpu_time()
+        
+        with open(filepath, "rb") as f:
+            if self.content_length is None:
+                method = "chunked"
+                bytes_sent = self.write_chunked(f)
+            else:
+                f.seek(self.range_offset)
+                
+                if hasattr(os, "sendfile"):
+                    method = "sendfile"
+                    bytes_sent = self.write_sendfile(f, self.content_length)
+                else:
+                    method = "copy"
+                    bytes_sent = self.write_copy(f, self.content_length)
+                
+        report_transfer(method, bytes_sent, time.time() - start_time, get_cpu_time() - start_cpu)
+
+
+    def write_sendfile(self, f, length):
+        """ send the file body straight from the kernel page cache to the socket """
+        self.wfile.flush()
+        
+        out_fd = self.connection.fileno()
+        in_fd = f.fileno()
+        
+        offset = f.tell()
+        remaining = length
+        while remaining > 0:
+            try:
+                sent = os.sendfile(out_fd, in_fd, offset, min(remaining, SENDFILE_BLOCK_SIZE))
+            except OSError as e:
+                if e.errno in (errno.EINVAL, errno.ENOSYS):
+                    # sendfile isn't supported for this file - fall back to a plain copy
+                    f.seek(offset)
+                    return (length - remaining) + self.write_copy(f, remaining)
+                raise
+                
+            if sent == 0:
+                break
+                
+            offset += sent
+            remaining -= sent
+            
+        return length - remaining
+        
+
+    def write_copy(self, f, length):
+        """ send the file body with read / write calls """
+        remaining = length
+        while remaining > 0:
+            data = f.read(min(remaining, CHUNK_SIZE))
+            if len(data) == 0:
+                break
+                
+            self.wfile.write(data)
+            remaining -= len(data)
+            
+        return length - remaining
+        
+        
+    def write_chunked(self, f):
+        """ send the file body using chunked transfer encoding """
+        bytes_sent = 0
+        while True:
+            data = f.read(CHUNK_SIZE)
+            if len(data) == 0:
+                break
+                
+            self.write_chunk(data)
+            bytes_sent += len(data)
+
+        self.write_last_chunk()
+        
+        return bytes_sent
+        
+
+    def write_chunk(self, data):
+        """ write a single chunk with its size header """
+        self.wfile.write(("%X\r\n" % len(data)).encode() + data + b"\r\n")
+        
+        
+    def write_last_chunk(self):
+        """ write the zero length chunk marking the end of the response """
+        self.wfile.write(b"0\r\n\r\n")
+
+
+class TranscodeBuffer():
+    """ A bounded buffer of fixed size blocks between the transcoder output and the http client.
+    
+        When the buffer reaches its high watermark, reading from the transcoder stops until the client
+        has drained it down to the low watermark. The transcoder then blocks on its full output pipe
+        instead of memory growing while the client is slow. """
+    
+    def __init__(self, capacity, block_size=TRANSCODE_BLOCK_SIZE):
+        self.block_size = block_size
+        self.high_watermark = max(capacity, block_size)
+        self.low_watermark = self.high_watermark // 2
+        
+        self.blocks = deque()
+        self.fill = 0
+        self.closed = False
+        self.aborted = False
+        self.condition = Condition()
+        
+        # statistics
+        self.start_time = time.time()
+        self.bytes_out = 0
+        self.max_fill = 0
+        self.fill_total = 0
+        self.fill_samples = 0
+        self.producer_stalls = 0
+        self.consumer_stalls = 0
+        
+        
+    def fill_from(self, stream):
+        """ read the stream in fixed size blocks until it ends or the buffer is aborted """
+        try:
             while True:
-                line = f.read(1024)
-                if len(line) == 0:
+                block = stream.read(self.block_size)
+                if len(block) == 0:
+                    break
+                
+                if not self.put(block):
                     break
+        finally:
+            self.close()
+            
+            
+    def put(self, block):
+        """ add a block, waiting for the client to drain the buffer if it is full. returns False if the buffer was aborted """
+        with self.condition:
+            if self.fill + len(block) > self.high_watermark and not self.aborted:
+                self.producer_stalls += 1
+                while self.fill > self.low_watermark and not self.aborted:
+                    self.condition.wait()
+                
+            if self.aborted:
+                return False
+                
+            self.blocks.append(block)
+            self.fill += len(block)
+            self.max_fill = max(self.max_fill, self.fill)
+            
+            self.condition.notify_all()
+            
+        return True
+        
+        
+    def get(self):
+        """ remove the next block, waiting for the transcoder if the buffer is empty. returns None at the end of the stream """
+        with self.condition:
+            if len(self.blocks) == 0 and not self.closed and not self.aborted:
+                self.consumer_stalls += 1
+                while len(self.blocks) == 0 and not self.closed and not self.aborted:
+                    self.condition.wait()
+                    
+            if len(self.blocks) == 0:
+                return None
+                
+            self.fill_total += self.fill
+            self.fill_samples += 1
+                
+            block = self.blocks.popleft()
+            self.fill -= len(block)
+            self.bytes_out += len(block)
+            
+            if self.fill <= self.low_watermark:
+                self.condition.notify_all()
+                
+        return block
+        
+        
+    def close(self):
+        """ mark the end of the transcoder output """
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+            
             
-                chunk_size = "%0.2X" % len(line)
-                self.wfile.write(chunk_size.encode())
-                self.wfile.write(b"\r\n")
-                self.wfile.write(line)
-                self.wfile.write(b"\r\n")
+    def abort(self):
+        """ stop buffering, e.g. when the client has disconnected """
+        with self.condition:
+            self.aborted = True
+            self.blocks.clear()
+            self.fill = 0
+            self.condition.notify_all()
+            
+            
+    def report(self):
+        """ display the buffer statistics """
+        elapsed = time.time() - self.start_time
+        
+        bitrate = 0
+        if elapsed > 0:
+            bitrate = self.bytes_out * 8 / elapsed / 1000
+            
+        average_fill = 0
+        if self.fill_samples > 0:
+            average_fill = 100.0 * self.fill_total / self.fill_samples / self.high_watermark
+        
+        print("transcode buffer: average fill %.0f%%, max fill %d of %d KB, %d transcoder stalls, %d client stalls, %.0f kbit/s" % (
+            average_fill, self.max_fill // 1024, self.high_watermark // 1024, self.producer_stalls, self.consumer_stalls, bitrate))
 
-        self.wfile.write(b"0")
-        self.wfile.write(b"\r\n\r\n")
 
 
 class TranscodingRequestHandler(RequestHandler):
     """ Handle HTTP requests for files which require realtime transcoding with ffmpeg """
     transcoder_command = FFMPEG
+    codec_options = VIDEO_TRANSCODE_OPTIONS
     transcode_options = ""
     transcode_input_options = ""    
     bufsize = 0
-                    
+    
+    def get_file_size(self, filepath):
+        """ the length of transcoded output is never known in advance """
+        return None
+    
     def write_response(self, filepath):
-        if self.bufsize != 0:
-            print("transcode buffer size: " + self.bufsize)
+        buffer_size = self.bufsize
+        if buffer_size <= 0:
+            buffer_size = TRANSCODE_BUFFER_SIZE
+            
+        print("transcode buffer size: %d" % buffer_size)
         
-        ffmpeg_command = self.transcoder_command % (self.transcode_input_options, filepath, self.transcode_options) 
+        ffmpeg_command = self.transcoder_command % (self.transcode_input_options, filepath, self.codec_options, self.transcode_options) 
         
-        ffmpeg_process = subprocess.Popen(ffmpeg_command, stdout=subprocess.PIPE, shell=True, bufsize=self.bufsize)       
+        ffmpeg_process = subprocess.Popen(ffmpeg_command, stdout=subprocess.PIPE, shell=True, bufsize=TRANSCODE_BLOCK_SIZE)       
 
-        for line in ffmpeg_process.stdout:
-            chunk_size = "%0.2X" % len(line)
-            self.wfile.write(chunk_size.encode())
-            self.wfile.write(b"\r\n")
-            self.wfile.write(line)
-            self.wfile.write(b"\r\n")
+        transcode_buffer = TranscodeBuffer(buffer_size)
+        
+        pump = Thread(target=transcode_buffer.fill_from, args=(ffmpeg_process.stdout,))
+        pump.daemon = True
+        pump.start()
+        
+        try:
+            while True:
+                block = transcode_buffer.get()
+                if block is None:
+                    break
+                    
+                self.write_chunk(block)
 
-        self.wfile.write(b"0")
-        self.wfile.write(b"\r\n\r\n")
+            self.write_last_chunk()
+            
+        finally:
+            transcode_buffer.abort()
+            
+            # stop the transcoder if the client went away before the end of the output
+            if ffmpeg_process.poll() is None:
+                ffmpeg_process.terminate()
+            ffmpeg_process.wait()
+            
+            transcode_buffer.report()
 
 
 class SubRequestHandler(RequestHandler):
@@ -308,11 +727,200 @@ def get_transcoder_cmds(preferred_transcoder=None):
 
 def is_transcoder_installed(transcoder_application):
     """ check for an installation of either ffmpeg or avconv """
+    return get_transcoder_capabilities(transcoder_application) is not None
+    
+    
+    
+def get_transcoder_capabilities(transcoder_application):
+    """ get the path, version, encoders, muxers & hardware acceleration methods of ffmpeg or avconv.
+        The results are cached until the transcoder binary is modified. returns None if it isn't installed """
+    path = find_executable(transcoder_application)
+    if path is None:
+        return None
+        
+    path = os.path.realpath(path)
     try:
-        subprocess.check_output([transcoder_application, "-version"])
-        return True
+        mtime = os.stat(path).st_mtime
     except OSError:
-        return False
+        return None
+        
+    cache = load_transcoder_cache()
+    
+    capabilities = cache.get(transcoder_application)
+    if capabilities is not None and capabilities.get('path') == path and capabilities.get('mtime') == mtime and 'video_encoder' in capabilities:
+        return capabilities
+        
+    try:
+        version = read_transcoder_output(path, "-version")
+    except (OSError, subprocess.CalledProcessError):
+        return None
+        
+    capabilities = {'path':path,
+                    'mtime':mtime,
+                    'version':(version.splitlines() or [""])[0],
+                    'encoders':parse_transcoder_list(read_transcoder_output(path, "-encoders"), 1),
+                    'muxers':parse_transcoder_list(read_transcoder_output(path, "-muxers"), 1),
+                    'hwaccels':parse_transcoder_list(read_transcoder_output(path, "-hwaccels"), 0)}
+                    
+    capabilities['video_encoder'] = find_video_encoder(path, capabilities['encoders'])
+    
+    cache[transcoder_application] = capabilities
+    save_transcoder_cache(cache)
+    
+    return capabilities
+    
+    
+    
+def find_video_encoder(path, encoders):
+    """ returns the first H.264 encoder in order of preference which is listed by the transcoder and can encode a 
+        test frame, or None if there isn't one - the transcoder then uses its default encoder """
+    for encoder in H264_ENCODERS:
+        if encoder not in encoders:
+            continue
+            
+        trial_command = [path, "-loglevel", "error", "-f", "lavfi", "-i", "nullsrc=s=256x144", 
+                         "-frames:v", "1", "-c:v", encoder, "-f", "null", "-"]
+        
+        with open(os.devnull, "w") as devnull:
+            try:
+                subprocess.check_call(trial_command, stdin=devnull, stdout=devnull, stderr=devnull)
+                return encoder
+            except (OSError, subprocess.CalledProcessError):
+                print("the %s encoder is listed by the transcoder but isn't usable" % encoder)
+                
+    return None
+    
+    
+    
+def read_transcoder_output(path, option):
+    """ run the transcoder with a single informational option and return its output, or "" if the option is not supported """
+    with open(os.devnull, "w") as devnull:
+        try:
+            return subprocess.check_output([path, option], stderr=devnull).decode("utf-8", "replace")
+        except subprocess.CalledProcessError:
+            if option == "-version":
+                raise
+            return ""
+            
+            
+            
+def parse_transcoder_list(output, name_column):
+    """ extract the names from a transcoder listing such as -encoders, -muxers or -hwaccels.
+        name_column is the position of the name on each line, after any capability flags """
+    names = []
+    
+    for line in output.splitlines():
+        columns = line.split()
+        
+        # skip the list heading, the legend and its separator line
+        if len(columns) <= name_column or line.strip().endswith(":") or columns[0].startswith("--") or "=" in columns:
+            continue
+            
+        names.append(columns[name_column])
+        
+    return names
+    
+    
+    
+def load_transcoder_cache():
+    """ read the transcoder capabilities cache file """
+    try:
+        with open(os.path.expanduser(TRANSCODER_CACHE_FILE), "r") as f:
+            cache = json.load(f)
+            if isinstance(cache, dict):
+                return cache
+    except (IOError, ValueError):
+        pass
+        
+    return {}
+    
+    
+    
+def save_transcoder_cache(cache):
+    """ save the transcoder capabilities cache file, replacing any previous version in one step """
+    save_cache_file(TRANSCODER_CACHE_FILE, cache)
+    
+    
+    
+def save_cache_file(cache_file, cache):
+    """ write a cache as JSON, replacing any previous version in one step - errors are ignored """
+    filepath = os.path.expanduser(cache_file)
+    try:
+        temp_fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(filepath))
+        with os.fdopen(temp_fd, "w") as f:
+            json.dump(cache, f)
+        os.rename(temp_path, filepath)
+    except (IOError, OSError):
+        pass
+        
+        
+        
+def get_file_key(filename):
+    """ returns the path, size & modification time identifying the current version of a file, 
+        or None if it isn't a local file """
+    try:
+        file_stat = os.stat(filename)
+    except OSError:
+        return None
+        
+    return os.path.abspath(filename), file_stat.st_size, file_stat.st_mtime
+    
+    
+    
+def get_media_cache_entry(filename):
+    """ returns the cached results for the file, or an empty dict if it isn't cached or has been modified """
+    file_key = get_file_key(filename)
+    if file_key is None:
+        return {}
+        
+    try:
+        with open(os.path.expanduser(MEDIA_CACHE_FILE), "r") as f:
+            cache = json.load(f)
+    except (IOError, ValueError):
+        return {}
+        
+    path, size, mtime = file_key
+    
+    entry = cache.get(path) if isinstance(cache, dict) else None
+    if not isinstance(entry, dict) or entry.get('size') != size or entry.get('mtime') != mtime:
+        return {}
+        
+    return entry
+    
+    
+    
+def update_media_cache(filename, **results):
+    """ add results for the file to the media cache. The cache is locked while it is updated, 
+        and the least recently updated files are dropped once it holds MEDIA_CACHE_SIZE files """
+    file_key = get_file_key(filename)
+    if file_key is None:
+        return
+        
+    path, size, mtime = file_key
+    
+    with cc_device_finder.CacheLock(MEDIA_CACHE_FILE):
+        try:
+            with open(os.path.expanduser(MEDIA_CACHE_FILE), "r") as f:
+                cache = json.load(f)
+            if not isinstance(cache, dict):
+                cache = {}
+        except (IOError, ValueError):
+            cache = {}
+            
+        entry = cache.get(path)
+        if not isinstance(entry, dict) or entry.get('size') != size or entry.get('mtime') != mtime:
+            entry = {'size':size, 'mtime':mtime}
+            
+        entry.update(results)
+        entry['updated'] = time.time()
+        cache[path] = entry
+        
+        if len(cache) > MEDIA_CACHE_SIZE:
+            oldest = sorted(cache, key=lambda cached_path: cache[cached_path].get('updated', 0))
+            for cached_path in oldest[:len(cache) - MEDIA_CACHE_SIZE]:
+                del cache[cached_path]
+                
+        save_cache_file(MEDIA_CACHE_FILE, cache)
        
 
 
@@ -338,6 +946,53 @@ def save_pid(device_ip):
 
 
 
+def sniff_mimetype(header, guess=None):
+    """ identify the container format from the magic bytes at the start of a file.
+        guess is the mimetype suggested by the file extension, used to tell audio-only files apart.
+        returns None if the header doesn't identify the format on its own """
+    is_audio = guess is not None and guess.startswith("audio/")
+    
+    # MP4 / M4A
+    if header[4:8] == b"ftyp":
+        if is_audio or header[8:12] in (b"M4A ", b"M4B ", b"M4P "):
+            return "audio/mp4"
+        return "video/mp4"
+        
+    # Matroska / WebM
+    if header[:4] == b"\x1a\x45\xdf\xa3":
+        if b"webm" not in header[:64] and b"matroska" not in header[:64]:
+            return None
+        if is_audio:
+            return "audio/webm"
+        return "video/webm"
+        
+    # Ogg - identified by the codec of the first stream
+    if header[:4] == b"OggS":
+        if b"\x80theora" in header[:64]:
+            return "video/ogg"
+        for audio_codec in (b"\x01vorbis", b"OpusHead", b"\x7fFLAC", b"Speex"):
+            if audio_codec in header[:64]:
+                return "audio/ogg"
+        return None
+        
+    if header[:4] == b"RIFF" and header[8:12] == b"WAVE":
+        return "audio/wav"
+        
+    if header[:4] == b"fLaC":
+        return "audio/flac"
+        
+    # MP3 - either an ID3 tag or an MPEG audio frame sync with a non-zero layer (layer 0 is ADTS AAC)
+    if header[:3] == b"ID3":
+        return "audio/mpeg"
+        
+    frame_header = bytearray(header[:2])
+    if len(frame_header) == 2 and frame_header[0] == 0xFF and frame_header[1] & 0xE0 == 0xE0 and frame_header[1] & 0x06 != 0:
+        return "audio/mpeg"
+        
+    return None
+    
+    
+    
 def get_mimetype(filename, ffprobe_cmd=None):
     """ find the container format of the file """
     # default value
@@ -348,50 +1003,51 @@ def get_mimetype(filename, ffprobe_cmd=None):
     guess = mimetypes.guess_type(filename)[0]
     if guess is not None:
         if guess.lower().startswith("video/") or guess.lower().startswith("audio/"):
-            mimetype = guess
+            mimetype = guess.lower()
       
         
-    # use the OS file command...
-    try:
-        file_cmd = 'file --mime-type -b "%s"' % filename
-        file_mimetype = subprocess.check_output(file_cmd, shell=True).strip().lower()
+    cached_mimetype = get_media_cache_entry(filename).get('mimetype')
+    if cached_mimetype is not None:
+        print("cached mimetype: " + cached_mimetype)
+        return cached_mimetype
+        
         
-        if file_mimetype.startswith("video/") or file_mimetype.startswith("audio/"):
-            mimetype = file_mimetype
+    # identify the container from the file header...
+    try:
+        with open(filename, "rb") as f:
+            header = f.read(SNIFF_SIZE)
             
-            print("OS identifies the mimetype as : " + mimetype)
-            return mimetype
-    except:
+        sniffed_mimetype = sniff_mimetype(header, guess)
+        if sniffed_mimetype is not None:
+            print("file header identifies the mimetype as : " + sniffed_mimetype)
+            update_media_cache(filename, mimetype=sniffed_mimetype)
+            return sniffed_mimetype
+    except IOError:
         pass
     
     
-    # use ffmpeg/avconv if installed
-    if ffprobe_cmd is None:
-        return mimetype
+    mimetype = probe_mimetype(filename, ffprobe_cmd, mimetype)
     
-    # ffmpeg/avconv is installed
-    has_video = False
-    has_audio = False
-    format_name = None
+    update_media_cache(filename, mimetype=mimetype)
     
-    ffprobe_cmd = '%s -show_streams -show_format "%s"' % (ffprobe_cmd, filename)
-    ffmpeg_process = subprocess.Popen(ffprobe_cmd, stdout=subprocess.PIPE, shell=True)
-
-    for line in ffmpeg_process.stdout:
-        if line.startswith(b"codec_type=audio"):
-            has_audio = True
-        elif line.startswith(b"codec_type=video"):
-            has_video = True
-        elif line.startswith(b"format_name="):
-            name, value = line.split(b"=")
-            format_name = value.strip().lower().split(b",")
-
-
-    # use the default if it isn't possible to identify the format type
-    if format_name is None:
+    return mimetype
+    
+    
+    
+def probe_mimetype(filename, ffprobe_cmd, mimetype):
+    """ find the container format with ffmpeg/avconv, returns the mimetype passed in if it can't be identified """
+    media_info = probe_media(filename, ffprobe_cmd)
+    if media_info is None:
         return mimetype
     
+    has_video = False
+    for stream in media_info['streams']:
+        if stream.get("codec_type") == "video":
+            has_video = True
+            
+    format_name = media_info['format_name']
     
+
     if has_video:
         mimetype = "video/"
     else:
@@ -412,6 +1068,144 @@ def get_mimetype(filename, ffprobe_cmd=None):
         
     return mimetype
     
+    
+    
+    
+def probe_media(filename, ffprobe_cmd):
+    """ read the container format and the codec details of each stream with ffprobe or avprobe.
+        returns None if the media can't be probed """
+    if ffprobe_cmd is None:
+        return None
+        
+    # the results of each probe command are cached separately, as ffprobe & avprobe output differs
+    probe_results = get_media_cache_entry(filename).get('probe', {})
+    if ffprobe_cmd in probe_results:
+        return probe_results[ffprobe_cmd]
+        
+    probe_command = '%s -show_streams -show_format "%s"' % (ffprobe_cmd, filename)
+    
+    try:
+        with open(os.devnull, "w") as devnull:
+            output = subprocess.check_output(probe_command, shell=True, stderr=devnull)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+        
+    streams = []
+    format_name = None
+    section = None
+    
+    # both the ffprobe & avprobe output consist of [section] headers followed by key=value lines
+    for line in output.decode("utf-8", "replace").splitlines():
+        line = line.strip()
+        
+        if line.startswith("["):
+            section = line.strip("[]").lower()
+            if section.startswith("/"):
+                section = None
+            elif "stream" in section:
+                streams.append({})
+            
+        elif "=" in line and section is not None:
+            key, value = line.split("=", 1)
+            
+            if "stream" in section and len(streams) > 0:
+                streams[-1][key] = value
+            elif section == "format" and key == "format_name":
+                format_name = value.strip().lower().split(",")
+                
+    media_info = None
+    
+    # use the default if it isn't possible to identify the format type
+    if format_name is not None:
+        media_info = {'format_name':format_name, 'streams':streams}
+        
+    probe_results[ffprobe_cmd] = media_info
+    update_media_cache(filename, probe=probe_results)
+    
+    return media_info
+    
+    
+    
+def can_copy_stream(stream):
+    """ check whether the Chromecast can play a stream without it being transcoded """
+    codec_type = stream.get("codec_type")
+    codec_name = stream.get("codec_name", "").lower()
+    
+    if codec_type == "audio":
+        return codec_name in COPY_AUDIO_CODECS
+        
+    if codec_type == "video":
+        if codec_name not in COPY_VIDEO_CODECS:
+            return False
+            
+        if stream.get("profile", "").lower() not in COPY_VIDEO_PROFILES:
+            return False
+            
+        if stream.get("pix_fmt", "yuv420p").lower() not in COPY_VIDEO_PIXEL_FORMATS:
+            return False
+            
+        try:
+            level = int(stream.get("level", 0))
+        except ValueError:
+            level = 0
+            
+        return level <= COPY_VIDEO_MAX_LEVEL
+        
+    return True
+    
+    
+
+def get_encoder_options(capabilities):
+    """ choose the video & audio encoders supported by the transcoder, returns a tuple of (video options, audio options) """
+    video_options = VIDEO_TRANSCODE_OPTIONS
+    audio_options = AUDIO_TRANSCODE_OPTIONS
+    
+    if capabilities is None:
+        return video_options, audio_options
+        
+    encoders = capabilities.get('encoders', [])
+    
+    video_encoder = capabilities.get('video_encoder')
+    if video_encoder is not None:
+        video_options = "-c:v %s %s" % (video_encoder, VIDEO_ENCODER_OPTIONS.get(video_encoder, VIDEO_BITRATE_OPTIONS))
+            
+    for encoder in AAC_ENCODERS:
+        if encoder in encoders:
+            audio_options = "-c:a %s" % encoder
+            break
+            
+    return video_options, audio_options
+    
+    
+    
+def get_codec_options(media_info, capabilities=None):
+    """ decide whether the video & audio streams can be copied (remuxed) or need to be transcoded, 
+        returns the codec options to pass to the transcoder """
+    video_transcode_options, audio_transcode_options = get_encoder_options(capabilities)
+    
+    if media_info is None:
+        print("unable to probe the media - transcoding all streams")
+        return " ".join([option for option in (video_transcode_options, audio_transcode_options) if option != ""])
+    
+    options = []
+    
+    for codec_type, copy_options, transcode_options in (("video", VIDEO_COPY_OPTIONS, video_transcode_options), 
+                                                        ("audio", AUDIO_COPY_OPTIONS, audio_transcode_options)):
+        streams = [stream for stream in media_info['streams'] if stream.get("codec_type") == codec_type]
+        if len(streams) == 0:
+            continue
+            
+        codecs = ", ".join([stream.get("codec_name", "unknown") for stream in streams])
+        
+        if all([can_copy_stream(stream) for stream in streams]):
+            print("copying %s stream (%s)" % (codec_type, codecs))
+            options.append(copy_options)
+        else:
+            print("transcoding %s stream (%s)" % (codec_type, codecs))
+            options.append(transcode_options)
+            
+    return " ".join([option for option in options if option != ""])
+    
             
             
 def play(filename, transcode=False, transcoder=None, transcode_options=None, transcode_input_options=None,
@@ -422,7 +1216,7 @@ def play(filename, transcode=False, transcoder=None, transcode_options=None, tra
     print_ident()
     
     
-    cast = CCMediaController(device_name=device_name)
+    cast = CCMediaController(device_name=device_name, persistent=True)
     
     kill_old_pid(cast.host)
     save_pid(cast.host)    
@@ -459,6 +1253,12 @@ def play(filename, transcode=False, transcoder=None, transcode_options=None, tra
             else:
                 req_handler.transcoder_command = AVCONV
                 
+            capabilities = get_transcoder_capabilities(transcoder_cmd)
+            if capabilities is not None:
+                print("transcoder: " + capabilities['version'])
+                
+            req_handler.codec_options = get_codec_options(probe_media(filename, probe_cmd), capabilities)
+                
             if transcode_options is not None:    
                 req_handler.transcode_options = transcode_options
                 
@@ -474,17 +1274,17 @@ def play(filename, transcode=False, transcoder=None, transcode_options=None, tra
     if req_handler == RequestHandler:
         req_handler.content_type = get_mimetype(filename, probe_cmd)
         
+    req_handler.allowed_path = filename
+        
     
-    # create a webserver to handle a single request for the media file on either a free port or on a specific port if passed in the port parameter   
+    # create a webserver to handle requests for the media file on either a free port or on a specific port if passed in the port parameter   
     port = 0    
     
     if server_port is not None:
         port = int(server_port)
         
-    server = BaseHTTPServer.HTTPServer((webserver_ip, port), req_handler)
-    
-    thread = Thread(target=server.handle_request)
-    thread.start()
+    server = start_server(webserver_ip, port, req_handler)
+    servers = [server]
 
 
     url = "http://%s:%s?%s" % (webserver_ip, str(server.server_port), quote_plus(filename, "/"))
@@ -513,9 +1313,9 @@ def play(filename, transcode=False, transcoder=None, transcode_options=None, tra
             if subtitles_port is not None:
                 sub_port = int(subtitles_port)
 
-            sub_server = BaseHTTPServer.HTTPServer((webserver_ip, sub_port), SubRequestHandler)
-            thread2 = Thread(target=sub_server.handle_request)
-            thread2.start()
+            SubRequestHandler.allowed_path = subtitles
+            sub_server = start_server(webserver_ip, sub_port, SubRequestHandler)
+            servers.append(sub_server)
 
             sub = "http://%s:%s?%s" % (webserver_ip, str(sub_server.server_port), quote_plus(subtitles, "/"))
             print("sub URL: " + sub)
@@ -523,7 +1323,30 @@ def play(filename, transcode=False, transcoder=None, transcode_options=None, tra
             print("Subtitles file %s not found" % subtitles)
 
 
-    load(cast, url, req_handler.content_type, sub, subtitles_language)
+    try:
+        load(cast, url, req_handler.content_type, sub, subtitles_language)
+    finally:
+        for server in servers:
+            stop_server(server)
+
+
+
+def start_server(webserver_ip, port, req_handler):
+    """ start a webserver which serves requests in the background until it is stopped """
+    server = MediaServer((webserver_ip, port), req_handler)
+    
+    thread = Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    
+    return server
+
+
+
+def stop_server(server):
+    """ stop a webserver started by start_server and release its port """
+    server.shutdown()
+    server.server_close()
 
     
     
@@ -538,10 +1361,7 @@ def load(cast, url, mimetype, sub=None, sub_language=None):
         # wait for playback to complete before exiting
         print("waiting for player to finish - press ctrl-c to stop...")
         
-        idle = False
-        while not idle:
-            time.sleep(1)
-            idle = cast.is_idle()
+        cast.wait_for_idle()
    
     except KeyboardInterrupt:
         print("")
@@ -549,6 +1369,7 @@ def load(cast, url, mimetype, sub=None, sub_language=None):
         cast.stop()
         
     finally:
+        cast.close_socket()
         print("done")
     
     
@@ -637,54 +1458,78 @@ def playurl(url, device_name=None):
         mimetype = "video/mp4"
         print("resource does not specify mimetype - using default: " + mimetype)
     
-    cast = CCMediaController(device_name=device_name)
+    cast = CCMediaController(device_name=device_name, persistent=True)
     load(cast, url, mimetype)    
     
 
             
     
+def run_device_command(command, device_name, *args):
+    """ run a controller command on the device, or on each device in a list of names at the same time """
+    
+    if not isinstance(device_name, list):
+        return getattr(CCMediaController(device_name=device_name), command)(*args)
+        
+    device_names = device_name
+    
+    pool = CCDevicePool()
+    try:
+        results = pool.run_command(command, *args, device_names=device_names)
+    finally:
+        pool.close()
+        
+    for name in device_names:
+        if results.get(name) is not None:
+            print("%s: %s" % (name, results[name]))
+            
+    return results
+    
+    
 def pause(device_name=None):
     """ pause playback """
-    CCMediaController(device_name=device_name).pause()
+    run_device_command("pause", device_name)
 
 
 def unpause(device_name=None):
     """ continue playback """
-    CCMediaController(device_name=device_name).play()    
+    run_device_command("play", device_name)
 
         
 def stop(device_name=None):
     """ stop playback and quit the media player app on the chromecast """
-    CCMediaController(device_name=device_name).stop()
+    run_device_command("stop", device_name)
 
 
 def get_status(device_name=None):
     """ print the status of the chromecast device """
-    print(CCMediaController(device_name=device_name).get_status())
+    status = run_device_command("get_status", device_name)
+    if not isinstance(device_name, list):
+        print(status)
 
 def volume_up(device_name=None):
     """ raise the volume by 0.1 """
-    CCMediaController(device_name=device_name).set_volume_up()
+    run_device_command("set_volume_up", device_name)
 
 
 def volume_down(device_name=None):
     """ lower the volume by 0.1 """
-    CCMediaController(device_name=device_name).set_volume_down()
+    run_device_command("set_volume_down", device_name)
 
 
 def set_volume(v, device_name=None):
     """ set the volume to level between 0 and 1 """
-    CCMediaController(device_name=device_name).set_volume(v)
+    run_device_command("set_volume", device_name, v)
     
     
 def list_devices():
     print("Searching for devices, please wait...")
-    device_ips = cc_device_finder.search_network(device_limit=None, time_limit=10)
-    
-    print("%d devices found" % len(device_ips))
+    # each device is listed as soon as it responds
+    count = 0
+    for device in cc_device_finder.discover_named_devices(time_limit=10):
+        print(device['host'] + " : " + device['name'])
+        count += 1
     
-    for device_ip in device_ips:
-        print(device_ip + " : " + cc_device_finder.get_device_name(device_ip))
+    print("%d devices found" % count)
         
 
 def print_ident():
@@ -709,6 +1554,18 @@ def validate_args(args):
         
     if args[0] == "-setvol" and len(args) < 2:
         sys.exit(USAGETEXT) 
+        
+        
+        
+def get_named_arg_values(arg_name, args):
+    """ get the values of an argument which can be given more than once """
+    arg_vals = []
+    while arg_name in args:
+        arg_val = get_named_arg_value(arg_name, args)
+        if arg_val is not None:
+            arg_vals.append(arg_val)
+            
+    return arg_vals
     
 
 
@@ -743,7 +1600,14 @@ def run():
     
     
     # optional device name parm. if not specified, device_name = None (the first device found will be used).
-    device_name = get_named_arg_value("-devicename", args)
+    # when given more than once, device_name is the list of names and the command controls the group of devices
+    device_names = get_named_arg_values("-devicename", args)
+    
+    device_name = None
+    if len(device_names) == 1:
+        device_name = device_names[0]
+    elif len(device_names) > 1:
+        device_name = device_names
     
     # optional transcoder parm. if not specified, ffmpeg will be used, if installed, otherwise avconv.
     transcoder = get_named_arg_value("-transcoder", args)    
@@ -773,6 +1637,9 @@ def run():
         
     validate_args(args)
     
+    if isinstance(device_name, list) and args[0] not in GROUP_COMMANDS:
+        sys.exit("Only the %s commands can be used with a group of devices" % ", ".join(GROUP_COMMANDS))
+    
     if args[0] == "-stop":
         stop(device_name=device_name)
         